@@ -33,6 +33,7 @@ from struct import pack
 from io_scene_gmdc.gmdc_tools import *
 from itertools import count, repeat
 
+import numpy as np
 import bpy
 from mathutils import Vector as BlenderVector
 
@@ -160,7 +161,8 @@ def prepare_geometry(settings):
                         except AssertionError:
                             pass
                         except:
-                            log(
+                            count_event('influences ignored (no bone index in vertex group name)')
+                            log_enabled(LOG_DEBUG) and debug(
                                 'Warning! Could not extract bone index from vertex group name "%s". Influence on vertex # %i ignored.' % (
                                 name, v.index))
                         else:
@@ -201,6 +203,8 @@ def prepare_geometry(settings):
 
         # <- faces
 
+        log_counters('Warning! ')
+
         mesh_tangents = None
 
         #
@@ -433,10 +437,14 @@ def prepare_geometry(settings):
 
         log('--Creating new index group # %i, "%s" (triangles: %i)...' % (len(INDEX_GROUPS), name, len(indices) / 3))
 
+        if len(group.vertices) > 0x10000:
+            error('Error! Data group # %i has more than 65536 vertices.' % ref_group)
+            return False
+
         group = IndexGroup(name);
         INDEX_GROUPS.append(group)
         group.data_group_index = ref_group
-        group.indices = chunk(tuple(indices), 3)  # triangles
+        group.indices = np.array(indices, np.uint16).reshape(-1, 3)  # triangles
 
         indices = None
 
@@ -549,7 +557,11 @@ def prepare_geometry(settings):
                             a = t.transformPoint(Vector(a.x, a.y, a.z)).to_tuple()
                             V.append(a)
 
-                        I = chunk(I, 3)
+                        if len(V) > 0x10000:
+                            error('Error! Bounding mesh part # %i has more than 65536 vertices.' % idx)
+                            return False
+
+                        I = np.array(I, np.uint16).reshape(-1, 3)
 
                         dynamic_bmesh.append((V, I))
                         log('--Part # %02i -> vertices: %i, triangles: %i' % (idx, len(V), len(I)))
@@ -571,7 +583,10 @@ def prepare_geometry(settings):
                 else:
                     I.append((face.verts[0].index, face.verts[1].index, face.verts[2].index))
                     I.append((face.verts[0].index, face.verts[2].index, face.verts[3].index))
-            static_bmesh = (V, I)
+            if len(V) > 0x10000:
+                error('Error! Bounding mesh has more than 65536 vertices.')
+                return False
+            static_bmesh = (V, np.array(I, np.uint16).reshape(-1, 3))
 
             log('--Static bounding mesh -> vertices: %i, triangles: %i' % (len(V), len(I)))
 
@@ -582,6 +597,16 @@ def prepare_geometry(settings):
 # this function does basic checks and initiates the exporter
 
 def begin_export():
+    # the log level is set for the export and restored afterwards
+    # (gmdc_tools may be used by other scripts in the session)
+    level = set_log_level(LOG_INFO)
+    try:
+        _begin_export()
+    finally:
+        set_log_level(level)
+
+
+def _begin_export():
     bpy.app.Window.EditMode(0)
 
     settings = {
@@ -625,6 +650,9 @@ def begin_export():
         # Ok
         set_log_file(f)
 
+    # per-vertex messages only with the saved log; otherwise they are counted
+    set_log_level(_save_log and LOG_DEBUG or LOG_INFO)
+
     #
     # begin export
     #
@@ -28,10 +28,11 @@ Tooltip: 'Generate footprint for TS2 object' """
 # THE SOFTWARE.
 # -------------------------------------------------------------------------------
 
-from struct import pack
 from math import floor, ceil
 from itertools import product
-from io_scene_gmdc.gmdc_tools import log, error, set_log_file, close_log_file, print_last_exception, load_resource
+import numpy as np
+from io_scene_gmdc.gmdc_tools import log, error, set_log_file, close_log_file, print_last_exception, load_resource, \
+    footprint_data
 from io_scene_gmdc.gmdc_tools._resfile import DataListExtension, str_footprint
 
 import bpy
@@ -98,23 +99,16 @@ def generate_footprint():
         minx, maxx = int(floor(min(x) + 0.5)), int(ceil(max(x) + 0.5))
         miny, maxy = int(floor(min(y) + 0.5)), int(ceil(max(y) + 0.5))
 
-        data = [(0x02, 'minx', minx), (0x02, 'maxx', maxx - 1), (0x02, 'miny', miny), (0x02, 'maxy', maxy - 1)]
-
         log('--Name: "%s"' % name)
         log('--Size: %i x %i' % (maxx - minx, maxy - miny))
 
-        for x, y in product(range(minx, maxx), range(miny, maxy)):
-
-            key = '(%i,%i)' % (x, y)
+        grid = np.zeros(((maxy - miny) * 16, (maxx - minx) * 16), bool)
 
-            s = ''
-
-            for j in range(16):
-                a = sum(2 ** i for i in range(16) if test_point(x, y, i, j))
-                s += pack('<H', a)
-            data.append((0x09, key, s))
+        for x, y in product(range(minx, maxx), range(miny, maxy)):
+            for j, i in product(range(16), range(16)):
+                grid[(y - miny) * 16 + j, (x - minx) * 16 + i] = test_point(x, y, i, j)
 
-        footprint.append((0x07, name, data))
+        footprint.append((0x07, name, footprint_data(minx, miny, grid)))
 
     # <- objects
 
@@ -182,6 +176,7 @@ def update_cres(cres_filename):
         node = DataListExtension(len(res.nodes))
         res.nodes.append(node)
         res.nodes[0].extensions.append((1, 0, node.index))
+        res.nodes[0].mark_dirty()
 
     log()
 
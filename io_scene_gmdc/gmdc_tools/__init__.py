@@ -20,7 +20,13 @@
 # THE SOFTWARE.
 # -------------------------------------------------------------------------------
 
-from ._common import log, error, set_log_file, close_log_file, chunk, to_hex, print_last_exception
-from ._gmdc import DataGroup, IndexGroup, GeometryData, create_gmdc_file
-from ._resfile import load_resource
+from ._common import log, debug, logf, error, set_log_file, close_log_file, flush_log, set_log_level, log_enabled, \
+    count_event, log_counters, LOG_ERROR, LOG_INFO, LOG_DEBUG, chunk, to_hex, print_last_exception
+from ._gmdc import DataGroup, IndexGroup, GeometryData, TupleView, MappedArray, GeometryInfo, probe_gmdc, patch_gmdc_section, \
+    create_gmdc_file, serialize_gmdc, GMDCWriter
+from ._resfile import load_resource, load_resources, load_resource_index, set_resource_cache, clear_resource_cache, \
+    resource_cache_info, set_geometry_cache, clear_geometry_cache, footprint_grid, footprint_data
+from ._package import Package, link_key
+from ._refpack import refpack_decompress, refpack_compress, is_refpack, refpack_benchmark
+from ._resolver import ResourceIndex
 from ._tree import Vector, Matrix, Quaternion, Transform, build_transform_tree
@@ -22,12 +22,15 @@
 
 from __future__ import print_function, division
 
-__all__ = ['log', 'error', 'set_log_file', 'close_log_file', 'chunk', 'chain', 'repeat', 'to_hex',
-           'print_last_exception', 'read_str', 'write_str']
+__all__ = ['log', 'debug', 'logf', 'error', 'set_log_file', 'close_log_file', 'flush_log', 'set_log_level',
+           'log_enabled', 'count_event', 'log_counters', 'LOG_ERROR', 'LOG_INFO', 'LOG_DEBUG',
+           'chunk', 'chain', 'repeat', 'to_hex', 'print_last_exception', 'read_str', 'write_str', 'get_struct',
+           'Cursor']
 
 import sys
+import atexit
 from itertools import chain, repeat
-from struct import pack, unpack
+from struct import pack, unpack, Struct
 
 if sys.version_info[0] == 3:
     # Python 3
@@ -51,28 +54,107 @@ if sys.version_info[0] == 3:
     __all__ += ['xrange', 'map', 'filter', 'zip']
 
 
+########################################
+#  Logging
+########################################
+
+# levels
+LOG_ERROR, LOG_INFO, LOG_DEBUG = 0, 1, 2
+
+_LOG_BUFFER_SIZE = 4096  # lines kept before the console / log file is written to
+
+
+def set_log_level(level):
+    # returns the previous level
+    global log_level
+    previous, log_level = log_level, level
+    return previous
+
+
+def log_enabled(level):
+    # for guarding expensive messages:  log_enabled(LOG_DEBUG) and debug(...)
+    return level <= log_level
+
+
 def set_log_file(f):
+    # lines written to the log file (as well as to the console) are
+    # buffered until flush_log() / close_log_file(); errors are printed
+    # at once
     global log_file
+    flush_log()
     log_file = f
 
 
+def flush_log():
+    _flush_console()
+    if log_file != None and _log_lines:
+        log_file.write('\n'.join(_log_lines) + '\n')
+        del _log_lines[:]
+
+
 def close_log_file():
     global log_file
+    flush_log()
     if log_file != None:
         log_file.close();
         log_file = None
 
 
+def _flush_console():
+    if _console_lines:
+        sys.stdout.write('\n'.join(_console_lines) + '\n')
+        del _console_lines[:]
+        sys.stdout.flush()
+
+
+def _emit(s, stream):
+    if stream is sys.stdout:
+        _console_lines.append(s)
+    else:
+        # errors are not delayed (nor put before earlier messages)
+        _flush_console()
+        print(s, file=stream)
+    if log_file != None:
+        _log_lines.append(s)
+    (len(_console_lines) >= _LOG_BUFFER_SIZE or len(_log_lines) >= _LOG_BUFFER_SIZE) and flush_log()
+
+
 def log(*args):
-    s = '\x20'.join(str(x) for x in args)
-    print(s)
-    if log_file != None: print(s, file=log_file)
+    if log_level >= LOG_INFO:
+        _emit('\x20'.join(str(x) for x in args), sys.stdout)
+
+
+def debug(*args):
+    if log_level >= LOG_DEBUG:
+        _emit('\x20'.join(str(x) for x in args), sys.stdout)
+
+
+def logf(level, fmt, *args):
+    # the message is formatted only if the level is enabled
+    if level <= log_level:
+        _emit(fmt % args if args else fmt, sys.stderr if level == LOG_ERROR else sys.stdout)
 
 
 def error(*args):
-    s = '\x20'.join(str(x) for x in args)
-    print(s, file=sys.stderr)
-    if log_file != None: print(s, file=log_file)
+    _emit('\x20'.join(str(x) for x in args), sys.stderr)
+
+
+def count_event(name, n=1):
+    # summary counters, e.g. count_event('triangles reordered');
+    # reported (and reset) by log_counters()
+    try:
+        _counters[name] += n
+    except KeyError:
+        _counter_names.append(name)
+        _counters[name] = n
+
+
+def log_counters(prefix=''):
+    # logs lines like "1,532 triangles reordered"
+    for name in _counter_names:
+        log(prefix + '{:,}'.format(_counters[name]), name)
+    del _counter_names[:]
+    _counters.clear()
 
 
 def to_hex(s):
@@ -105,4 +187,114 @@ def write_str(f, s):
     f.write(pack('B', len(s)) + s)
 
 
+_structs = {}
+
+
+def get_struct(fmt):
+    # compiled struct.Struct, cached by format
+    try:
+        return _structs[fmt]
+    except KeyError:
+        st = _structs[fmt] = Struct(fmt)
+        return st
+
+
+class Cursor(object):
+    # sequential reader over a buffer (bytes, bytearray, memoryview, mmap);
+    # fields are unpacked in place with precompiled structs.
+    # read(), tell() and seek() behave as with a file object.
+
+    _u8 = Struct('B')
+    _i32 = Struct('<l')
+    _u32 = Struct('<L')
+    _f32 = Struct('<f')
+
+    def __init__(self, buf, pos=0):
+        self.buf = buf
+        self.pos = pos
+        self.size = len(buf)
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += self.size
+        self.pos = pos
+        return pos
+
+    def skip(self, n):
+        self.pos += n
+
+    def read(self, n=-1):
+        i = self.pos
+        j = self.size if n < 0 else min(i + n, self.size)
+        self.pos = j
+        return bytes(self.buf[i:j])
+
+    def unpack(self, st):
+        # st - Struct or format string
+        if not isinstance(st, Struct): st = get_struct(st)
+        v = st.unpack_from(self.buf, self.pos)
+        self.pos += st.size
+        return v
+
+    def unpack_array(self, st, n):
+        # list of n tuples
+        if not isinstance(st, Struct): st = get_struct(st)
+        i = self.pos
+        self.pos += st.size * n
+        return list(st.iter_unpack(self.buf[i:self.pos])) if n else []
+
+    def read_u8(self):
+        v = self._u8.unpack_from(self.buf, self.pos)[0]
+        self.pos += 1
+        return v
+
+    def read_i32(self):
+        v = self._i32.unpack_from(self.buf, self.pos)[0]
+        self.pos += 4
+        return v
+
+    def read_u32(self):
+        v = self._u32.unpack_from(self.buf, self.pos)[0]
+        self.pos += 4
+        return v
+
+    def read_f32(self):
+        v = self._f32.unpack_from(self.buf, self.pos)[0]
+        self.pos += 4
+        return v
+
+    def read_u16_array(self, n):
+        # tuple of n uint16
+        if not n: return ()
+        return self.unpack('<%iH' % n)
+
+    def read_str(self):
+        i = self._u8.unpack_from(self.buf, self.pos)[0] + self.pos + 1
+        s = self.buf[self.pos + 1:i]
+        self.pos = i
+        return bytes(s).decode('latin_1')
+
+    def expect_header(self, header, name):
+        i = self.pos
+        self.pos += len(header)
+        s = bytes(self.buf[i:self.pos])
+        if s != header:
+            error('Error! %s header:' % name, to_hex(s))
+            error('%#x' % self.pos)
+            return False
+        return True
+
+
 log_file = None
+log_level = LOG_INFO
+_log_lines = []
+_console_lines = []
+_counters = {}
+_counter_names = []  # in order of first occurrence
+
+atexit.register(flush_log)
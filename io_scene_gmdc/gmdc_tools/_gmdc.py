@@ -21,9 +21,17 @@
 # -------------------------------------------------------------------------------
 
 
-__all__ = ['DataGroup', 'IndexGroup', 'GeometryData', 'create_gmdc_file']
+__all__ = ['DataGroup', 'IndexGroup', 'GeometryData', 'TupleView', 'MappedArray', 'GeometryInfo', 'probe_gmdc',
+           'patch_gmdc_section', 'create_gmdc_file', 'serialize_gmdc', 'GMDCWriter']
 
-from struct import pack, unpack
+import os
+import hashlib
+from struct import pack, unpack, Struct
+from mmap import mmap, ACCESS_READ, ACCESS_WRITE
+from functools import partial
+from io import BytesIO
+
+import numpy as np
 
 from ._common import *
 from ._node import _SGNode
@@ -31,6 +39,13 @@ from ._node import _SGNode
 
 # Geometry data
 #
+# Loaded sections are stored as contiguous arrays: float32 (N, cc) for
+# vertices, normals, texture coords, weights, tangents, dVerts and dNorms;
+# uint8 (N, 4) for bones (padded with 0xFF), keys and mask.
+# Lists of tuples (as built by the exporter) are accepted as well.
+#
+# Sections of a loaded group are decoded on first access to the attribute.
+#
 class DataGroup(object):
     def __init__(self):
         self.count = 0
@@ -45,6 +60,103 @@ class DataGroup(object):
         self.dVerts = [[], [], [], []]
         self.dNorms = [[], [], [], []]
         self.tex_coords2 = []
+        self._pending = {}  # { attribute -> loader }
+        self._mappings = {}  # { attribute -> index mapping }
+        self.expand_mappings = True  # False - keep mapped sections as MappedArray
+
+    def __getattr__(self, name):
+        # called only for attributes that are not set, i.e. not decoded yet
+        try:
+            load = self.__dict__['_pending'].pop(name)
+        except KeyError:
+            raise AttributeError(name)
+        v = load()
+        m = self._mappings.pop(name, None)
+        if m is not None:
+            v = v[m] if self.expand_mappings else MappedArray(v, m)
+        setattr(self, name, v)
+        return v
+
+    def _defer(self, name, load, mapping=None):
+        self.__dict__.pop(name, None)
+        self._pending[name] = load
+        if mapping is not None:
+            self._mappings[name] = mapping
+
+    def _decode(self):
+        # decodes all deferred attributes
+        for name in list(self._pending):
+            getattr(self, name)
+
+    @property
+    def bone_counts(self):
+        # (N,) number of bone influences of each vertex
+        return _bone_counts(self.bones)
+
+    def as_tuples(self, name):
+        v = getattr(self, name)
+        if name in ('dVerts', 'dNorms'):
+            return [TupleView(x) for x in v]
+        return TupleView(v, 0xff if name == 'bones' else None)
+
+
+class TupleView(object):
+    # read-only sequence of tuples over an (N, cc) array;
+    # for code that still iterates lists of tuples
+
+    def __init__(self, array, strip=None):
+        self.array = array
+        self.strip = strip  # bones - cut off padding (0xFF)
+
+    def __len__(self):
+        return len(self.array)
+
+    def __iter__(self):
+        return (self._tuple(t) for t in np.asarray(self.array).tolist())
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._tuple(t) for t in np.asarray(self.array[i]).tolist()]
+        return self._tuple(np.asarray(self.array[i]).tolist())
+
+    def _tuple(self, t):
+        t = tuple(t)
+        if self.strip is not None and self.strip in t:
+            t = t[:t.index(self.strip)]
+        return t
+
+
+class MappedArray(object):
+    # lazily mapped section: row i is base[indices[i]];
+    # the base array is shared, not expanded in memory
+
+    def __init__(self, base, indices):
+        self.base = base
+        self.indices = indices
+
+    @property
+    def shape(self):
+        return (len(self.indices),) + self.base.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.base.dtype
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        return self.base[self.indices[i]]
+
+    def __iter__(self):
+        return iter(self.base[self.indices])
+
+    def __array__(self, dtype=None, copy=None):
+        a = self.base[self.indices]
+        return a if dtype is None else a.astype(dtype)
+
+    def tolist(self):
+        return self.base[self.indices].tolist()
 
 
 class IndexGroup(object):
@@ -72,27 +184,35 @@ class GeometryData(object):
 
 
 class GeometryDataContainer(_SGNode):
+    # geometry is changed in place (e.g. by remove_doubles)
+    _keep_raw = False
 
     def __init__(self, index):
         self.index = index
         self.type = 'cGeometryDataContainer'
         self.version = 0x04
 
-    def read(self, f, log_level=1):
-        s = f.read(27)
-        if s != b'\x16cGeometryDataContainer\x87\x86\x4F\xAC':
-            error('Error! cGeometryDataContainer header:', to_hex(s))
-            error('%#x' % f.tell())
-            return False
-        if not self._read_check_version(f, 0x04) or not self._read_csgresource(f): return False
-        self.geometry = _load_geometry_data(f, log_level)
+    def read(self, c, log_level=1):
+        if not c.expect_header(b'\x16cGeometryDataContainer\x87\x86\x4F\xAC', 'cGeometryDataContainer'): return False
+        if not self._read_check_version(c, 0x04) or not self._read_csgresource(c): return False
+        self.geometry = _load_geometry_data(c, log_level)
         return bool(self.geometry)
 
+    @staticmethod
+    def skip(c):
+        _SGNode._skip_header(c)
+        _SGNode._skip_csgresource(c)
+        _probe_geometry_data(c, GeometryInfo(None))
+        return True
+
     def write(self, f):
+        self._write_header(f)
+        f.write(_serialize_geometry_data(self.geometry))
+
+    def _write_header(self, f):
         f.write(b'\x16cGeometryDataContainer\x87\x86\x4F\xAC')
         self._write_version(f)
         self._write_csgresource(f)
-        _write_geometry_data(f, self.geometry)
 
     def __str__(self):
         s = 'cGeometryDataContainer'
@@ -103,8 +223,8 @@ class GeometryDataContainer(_SGNode):
             v = [group.vertices, group.normals, group.tex_coords, group.bones, group.weights, group.tangents,
                  group.mask, group.keys]
             s += '\x20\x20%i - Elements:%5i, ' % (i, group.count)
-            s += 'vertex: <' + "".join(map(lambda x, y: x if y else '', 'VNTBWXMK', v))
-            x, y = sum(map(bool, group.dVerts)), sum(map(bool, group.dNorms))
+            s += 'vertex: <' + "".join(map(lambda x, y: x if len(y) else '', 'VNTBWXMK', v))
+            x, y = sum(1 for v in group.dVerts if len(v)), sum(1 for v in group.dNorms if len(v))
             if x: s += ' dV(%i)' % x
             if y: s += ' dN(%i)' % y
             s += '>\n'
@@ -126,44 +246,91 @@ class GeometryDataContainer(_SGNode):
 ##  Geometry loader
 ########################################
 
-def _load_geometry_data(f, log_level):
-    #
-    # sections
-    #
-
-    dd = {
-        b'\x81\x07\x83\x5B': ('Vertices', 'V'),
-        b'\x8B\x07\x83\x3B': ('Normals', 'N'),
-        b'\xAB\x07\x83\xBB': ('TexCoords', 'T'),
-        b'\x11\x01\xD7\xFB': ('BoneIndices', 'B'),
-        b'\x05\x01\xD7\x3B': ('BoneWeights', 'W'),
-        b'\xA0\x2B\xD9\x89': ('Tangents', 'X'),
-        b'\xE1\xCF\xF2\x5C': ('DiffVerts', 'dV'),
-        b'\x6A\x3A\x6F\xCB': ('DiffNorms', 'dN'),
-        b'\xDC\xCF\xF2\xDC': ('DiffKeys', 'K'),
-        b'\x95\x07\x83\xDB': ('DeformMask', 'M'),
-        b'\x82\xEE\x4D\x7C': ('0x7C4DEE82', '1'),
-        b'\x5C\xFC\x4A\x5C': ('0x5C4AFC5C', '2'),
-        b'\x56\xFC\x4A\x1C': ('0x1C4AFC56', '3'),
-    }
-
-    if log_level:
-        log('//// Reading GMDC...')
-        log('==SECTIONS==============================')
+_SECTION_TYPES = {
+    b'\x81\x07\x83\x5B': ('Vertices', 'V'),
+    b'\x8B\x07\x83\x3B': ('Normals', 'N'),
+    b'\xAB\x07\x83\xBB': ('TexCoords', 'T'),
+    b'\x11\x01\xD7\xFB': ('BoneIndices', 'B'),
+    b'\x05\x01\xD7\x3B': ('BoneWeights', 'W'),
+    b'\xA0\x2B\xD9\x89': ('Tangents', 'X'),
+    b'\xE1\xCF\xF2\x5C': ('DiffVerts', 'dV'),
+    b'\x6A\x3A\x6F\xCB': ('DiffNorms', 'dN'),
+    b'\xDC\xCF\xF2\xDC': ('DiffKeys', 'K'),
+    b'\x95\x07\x83\xDB': ('DeformMask', 'M'),
+    b'\x82\xEE\x4D\x7C': ('0x7C4DEE82', '1'),
+    b'\x5C\xFC\x4A\x5C': ('0x5C4AFC5C', '2'),
+    b'\x56\xFC\x4A\x1C': ('0x1C4AFC56', '3'),
+}
+
+_SECTION_HEADER = Struct('<4l')  # sub index, type of data, unknown, size in bytes
+_INVERSE_TRANSFORM = Struct('<7f')  # rotation, translation
+
+_GROUP_ATTRS = {
+    'V': 'vertices',
+    'N': 'normals',
+    'T': 'tex_coords',
+    'B': 'bones',
+    'W': 'weights',
+    'X': 'tangents',
+    'M': 'mask',
+    'K': 'keys',
+}
+
+
+class _Section(object):
+    # section table entry; the payload is decoded on first call
+    # and cached, so data groups that share a section share its array
+
+    def __init__(self, type, sub_index, count, cc, dtype, offset, buf=None, data=None):
+        self.type = type
+        self.sub_index = sub_index
+        self.count = count
+        self.cc = cc
+        self.dtype = dtype
+        self.offset = offset  # of the payload
+        self.buf = buf
+        self._data = data
+
+    def __call__(self):
+        if self._data is None:
+            self._data = np.frombuffer(self.buf, self.dtype, self.count * self.cc, self.offset).reshape(self.count,
+                                                                                                          self.cc)
+        return self._data
+
+
+def _decode_all(sections):
+    return [s() if s else [] for s in sections]
+
+
+def _read_array(c, dtype, count):
+    # read-only array; a view into the cursor's buffer
+    a = np.frombuffer(c.buf, dtype, count, c.pos)
+    c.skip(a.nbytes)
+    return a
+
+
+def _read_triangles(c, count):
+    # (T, 3) uint16 array; count - number of indices
+    return _read_array(c, '<u2', count).reshape(-1, 3)
+
+
+def _read_section_table(c, log_level):
+    # returns [_Section or None]; payloads are skipped and decoded
+    # from the cursor's buffer when needed
 
     SECTIONS = []
 
     # number of sections
     #
-    section_count = unpack('<l', f.read(4))[0]
+    section_count = c.read_i32()
     log_level and log('Number of sections: %i' % section_count)
 
     for k in xrange(section_count):
 
-        offset = f.tell()
-        i = unpack('<l', f.read(4))[0]
-        s1, s2 = dd[f.read(4)]
-        sub_idx, type_of_data, unknown1, j = unpack('<4l', f.read(16))
+        offset = c.tell()
+        i = c.read_i32()
+        s1, s2 = _SECTION_TYPES[c.read(4)]
+        sub_idx, type_of_data, unknown1, j = c.unpack(_SECTION_HEADER)
 
         log_level and log('Section [%03i] @ %08x - ' % (k, offset) + s1 + (
                     j == 0 and (i and '\x20(empty, but count is %i)' % i or '\x20(empty)') or ''))
@@ -180,69 +347,61 @@ def _load_geometry_data(f, log_level):
             #
             assert j == 0
 
-            SECTIONS.append((None, None, None))
-
-        elif s1 in (
-                'Vertices',
-                'Normals',
-                'TexCoords',
-                'BoneWeights',
-                'Tangents',
-                'DiffVerts',
-                'DiffNorms'
-        ):
-            # component count
-            cc = type_of_data + 1
-
-            assert i * cc * 4 == j
-
-            data = chunk(unpack('<%if' % (i * cc), f.read(j)), cc)
-            SECTIONS.append((s2, sub_idx, data))
+            SECTIONS.append(None)
 
-        elif s1 == 'BoneIndices':
+        elif s2 in ('1', '2', '3'):  # 0x7C4DEE82, 0x5C4AFC5C, 0x1C4AFC56
 
-            assert i * 4 == j
+            # component count
+            cc = type_of_data + 1
 
-            data = unpack('%iB' % j, f.read(j))
+            c.skip(j)
 
-            log_level > 1 and log('--Index range: [%i-%i]' % (min(data), max(x for x in data if x != 0xff)))
+            # indices
+            i = c.read_i32()
+            c.skip(i * 2)
 
-            data = [v[:(v + (0xff,)).index(0xff)] for v in chunk(data, 4)]
-            SECTIONS.append(('B', sub_idx, data))
+            assert i == j // 4 // cc
 
-        elif s1 == 'DiffKeys' or s1 == 'DeformMask':
+            log_level > 1 and log('--Number of vectors, indices:', i)
 
-            assert i * 4 == j
+            # ignore this data
+            SECTIONS.append(None)
+            continue
 
-            data = chunk(unpack('%iB' % j, f.read(j)), 4)
-            SECTIONS.append((s2, sub_idx, data))
+        else:
+            if s2 in ('B', 'K', 'M'):
+                assert i * 4 == j
+                section = _Section(s2, sub_idx, i, 4, np.uint8, c.tell(), c.buf)
+            else:
+                # component count
+                cc = type_of_data + 1
+                assert i * cc * 4 == j
+                section = _Section(s2, sub_idx, i, cc, '<f4', c.tell(), c.buf)
 
-        else:  # 0x7C4DEE82, 0x5C4AFC5C, 0x1C4AFC56
+            c.skip(j)
 
-            # component count
-            cc = type_of_data + 1
+            if s2 == 'B' and log_level > 1:
+                v = section()
+                w = v[v != 0xff]
+                log('--Index range: [%i-%i]' % (v.min(), w.max() if len(w) else 0xff))
 
-            V = chunk(unpack('<%if' % (j // 4), f.read(j)), cc)
+            SECTIONS.append(section)
 
-            log_level > 1 and log('--Number of vectors, indices:', len(V))
+        assert c.read(4) == b'\x00\x00\x00\x00'
 
-        # indices
-        #
-        if s1 in ('0x7C4DEE82', '0x5C4AFC5C', '0x1C4AFC56') and 'V' in dir() and V != None:
+    return SECTIONS
 
-            i = unpack('<l', f.read(4))[0]
-            s = f.read(i * 2)
-            I = unpack('<%iH' % i, s)
 
-            assert len(I) == len(V)
+def _load_geometry_data(c, log_level):
+    #
+    # sections
+    #
 
-            # ignore this data
-            SECTIONS.append((None, None, None))
+    if log_level:
+        log('//// Reading GMDC...')
+        log('==SECTIONS==============================')
 
-        else:
-            assert f.read(4) == b'\x00\x00\x00\x00'
-
-    # <-
+    SECTIONS = _read_section_table(c, log_level)
 
     #
     # groups of data
@@ -254,7 +413,7 @@ def _load_geometry_data(f, log_level):
 
     # number of groups
     #
-    group_count = unpack('<l', f.read(4))[0]
+    group_count = c.read_i32()
 
     log_level and log('Number of groups: %i' % group_count)
 
@@ -265,20 +424,25 @@ def _load_geometry_data(f, log_level):
         DATA_GROUPS.append(group)
 
         # number of sections for this group
-        i = unpack('<l', f.read(4))[0]
+        i = c.read_i32()
 
         # section indices
-        s = f.read(i * 2)
-        indices = unpack('<%iH' % i, s)
+        indices = c.read_u16_array(i)
 
         log_level and log('Group %i:' % k, indices)
 
         # element count
-        group.count = unpack('<l', f.read(4))[0]
+        group.count = c.read_i32()
+
+        # sections are assigned here and decoded on first access
+        sections = {}  # { attribute -> _Section }
+        dVerts = [None] * 4
+        dNorms = [None] * 4
 
         for idx in indices:
-            type, sub_index, data = SECTIONS[idx]
-            if type:
+            section = SECTIONS[idx]
+            if section:
+                type, sub_index = section.type, section.sub_index
                 if type in ('T', 'dV', 'dN'):
                     if sub_index not in (0, 1, 2, 3):
                         error('Error! Section sub_index is out of range. (Section type: %s)' % type)
@@ -287,72 +451,63 @@ def _load_geometry_data(f, log_level):
                     if sub_index != 0:
                         error('Error! Section sub_index is not zero. (Section type: %s)' % type)
                         return False
-                if type == 'V':
-                    v = group.vertices
-                elif type == 'N':
-                    v = group.normals
-                elif type == 'B':
-                    v = group.bones
-                elif type == 'W':
-                    v = group.weights
-                elif type == 'X':
-                    v = group.tangents
-                elif type == 'M':
-                    v = group.mask
-                elif type == 'K':
-                    v = group.keys
-                elif type == 'dV':
-                    v = group.dVerts[sub_index]
+                if type == 'dV':
+                    v, name = dVerts, sub_index
                 elif type == 'dN':
-                    v = group.dNorms[sub_index]
-                elif type == 'T':
-                    v = group.tex_coords and group.tex_coords2
-                if v:
+                    v, name = dNorms, sub_index
+                else:
+                    v, name = sections, _GROUP_ATTRS[type]
+                    if type == 'T' and 'tex_coords' in sections:
+                        name = 'tex_coords2'
+                    v.setdefault(name, None)
+                if v[name]:
                     error('Error! List is not empty.')
                     error('Group: %i, Section index: %i, type: %s, sub_index: %i, element count: %i' % (
-                    len(DATA_GROUPS) - 1, idx, type, sub_index, j))
+                    len(DATA_GROUPS) - 1, idx, type, sub_index, section.count))
                     return False
-                v.extend(data)
+                v[name] = section
 
         # again number of sections (?)
-        j = unpack('<l', f.read(4))[0]
+        j = c.read_i32()
         assert j == i  # ?
 
         # validate rigging data
-        if group.bones and not group.weights:
+        if 'bones' in sections and 'weights' not in sections:
             error('Error! Incorrect rigging data. (no weights)')
             return False
 
         # validate morph data
-        i = sum(2 ** i for i, v in enumerate(group.dVerts) if v)
-        j = sum(2 ** j for j, v in enumerate(group.dNorms) if v)
+        i = sum(2 ** i for i, v in enumerate(dVerts) if v)
+        j = sum(2 ** j for j, v in enumerate(dNorms) if v)
         if i not in (0, 1, 3, 7, 15):
             error('Error! Invalid state of DiffVerts - %s' % format(i, '04b'))
             return False
         if j and j != i:
             error('Error! Invalid state of DiffNorms - %s (DiffVerts - %s)' % (format(j, '04b'), format(i, '04b')))
             return False
-        if i and not group.keys:
+        if i and 'keys' not in sections:
             error('Error! There are DiffVerts, but no DiffKeys in the group %i.' % (len(DATA_GROUPS) - 1))
             return False
 
         # index mapping
         #
-        i = unpack('<l', f.read(4))[0]
-        index_mapping1 = unpack('<%iH' % i, f.read(i * 2))
-
-        i = unpack('<l', f.read(4))[0]
-        index_mapping2 = unpack('<%iH' % i, f.read(i * 2))
+        index_mapping1 = _read_array(c, '<u2', c.read_i32())
+        index_mapping2 = _read_array(c, '<u2', c.read_i32())
+        index_mapping3 = _read_array(c, '<u2', c.read_i32())
 
-        i = unpack('<l', f.read(4))[0]
-        index_mapping3 = unpack('<%iH' % i, f.read(i * 2))
+        if len(index_mapping1) or len(index_mapping2) or len(index_mapping3):
+            assert not ('bones' in sections or 'keys' in sections)
 
-        if index_mapping1: v = group.vertices; group.vertices = [v[i] for i in index_mapping1]
-        if index_mapping2: v = group.normals; group.normals = [v[i] for i in index_mapping2]
-        if index_mapping3: v = group.tex_coords; group.tex_coords = [v[i] for i in index_mapping3]
+        mappings = {}
+        for name, mapping in (('vertices', index_mapping1), ('normals', index_mapping2),
+                              ('tex_coords', index_mapping3)):
+            if len(mapping) and name in sections:
+                mappings[name] = mapping
 
-        if index_mapping1 or index_mapping2 or index_mapping3:
-            assert not (group.bones or group.keys)
+        for name, section in sections.items():
+            group._defer(name, section, mappings.get(name))
+        if any(dVerts): group._defer('dVerts', partial(_decode_all, dVerts))
+        if any(dNorms): group._defer('dNorms', partial(_decode_all, dNorms))
 
         v = None
 
@@ -366,26 +521,25 @@ def _load_geometry_data(f, log_level):
 
     INDEX_GROUPS = []
 
-    index_group_count = unpack('<l', f.read(4))[0]
+    index_group_count = c.read_i32()
 
     log_level and log('Number of index groups:', index_group_count)
 
     for k in xrange(index_group_count):
 
-        log_level and log('Index group # %i @ %08x' % (k, f.tell()))
+        log_level and log('Index group # %i @ %08x' % (k, c.tell()))
 
-        type, data_group_index = unpack('<2l', f.read(8))
+        type, data_group_index = c.unpack('<2l')
         assert type == 2  # other primitives (if any), including 0-lines, are not supported
 
         log_level > 1 and log('--Refers to group:', data_group_index)
 
         # name
-        name = read_str(f)
+        name = c.read_str()
         log_level > 1 and log('--Name: "%s"' % name)
 
         # number of indices
-        i = unpack('<l', f.read(4))[0]
-        j = i * 2
+        i = c.read_i32()
         assert i % 3 == 0
 
         # add new index group
@@ -394,20 +548,19 @@ def _load_geometry_data(f, log_level):
         group.data_group_index = data_group_index
 
         # read indices
-        group.indices = chunk(unpack('<%iH' % i, f.read(j)), 3)
+        group.indices = _read_triangles(c, i)
 
         log_level > 1 and log('--Number of indices: %i (%i triangles)' % (i, len(group.indices)))
 
         # flags (?)
-        s = f.read(4)
+        s = c.read(4)
         log_level > 1 and log('--Flags (?):', to_hex(s))
         group.flags = unpack('<L', s)[0]
 
         # bone indices (if any)
-        i = unpack('<l', f.read(4))[0]
+        i = c.read_i32()
         if i != 0:
-            s = f.read(i * 2)
-            group.bones = unpack('<%iH' % i, s)
+            group.bones = c.read_u16_array(i)
             if log_level > 1:
                 if i <= 5:
                     log('--Bone indices: %i' % i, group.bones)
@@ -423,23 +576,24 @@ def _load_geometry_data(f, log_level):
 
     # inverse transforms
     #
-    k = unpack('<l', f.read(4))[0]
+    k = c.read_i32()
     if k:
-        log_level and log('Inverse transforms (%i) @ %08x' % (k, f.tell() - 4))
+        log_level and log('Inverse transforms (%i) @ %08x' % (k, c.tell() - 4))
         inverse_transforms = []
         for i in xrange(k):
-            inverse_transforms.append((unpack('<4f', f.read(16)), unpack('<3f', f.read(12))))
+            v = c.unpack(_INVERSE_TRANSFORM)
+            inverse_transforms.append((v[:4], v[4:]))
     else:
         inverse_transforms = None
 
     # morphs
     #
-    k = unpack('<l', f.read(4))[0]
+    k = c.read_i32()
     if k:
         log_level and log('Morphs / vertex animations (%i)' % k + (':' if log_level > 1 else ''))
         MORPH_NAMES = []
         for i in xrange(k):
-            v = (read_str(f), read_str(f))
+            v = (c.read_str(), c.read_str())
             log_level > 1 and log('--Strings: "%s", "%s"' % v)
             MORPH_NAMES.append(v)
     else:
@@ -447,36 +601,36 @@ def _load_geometry_data(f, log_level):
 
     # static bounding mesh
     #
-    i = unpack('<l', f.read(4))[0]
+    i = c.read_i32()
     if i:
-        j = unpack('<l', f.read(4))[0]
-        log_level and log('Static bounding mesh @ %08x' % (f.tell() - 4) + (':' if log_level > 1 else ''))
+        j = c.read_i32()
+        log_level and log('Static bounding mesh @ %08x' % (c.tell() - 4) + (':' if log_level > 1 else ''))
         if log_level > 1:
             log('--Vertices:', i)
             log('--Indices:', j)
 
         # read data
-        V = chunk(unpack('<%if' % (i * 3), f.read(i * 12)), 3)
-        I = chunk(unpack('<%iH' % j, f.read(j * 2)), 3)
+        V = _read_array(c, '<f4', i * 3).reshape(i, 3)
+        I = _read_triangles(c, j)
         static_bmesh = (V, I)
     else:
         static_bmesh = None
 
     # dynamic bounding mesh
     #
-    i = unpack('<l', f.read(4))[0]
+    i = c.read_i32()
     if i:
         log_level and log('Dynamic bounding mesh parts (%i)' % i + (':' if log_level > 1 else ''))
         dynamic_bmesh = []
         for k in xrange(i):
-            offset = f.tell()
-            i = unpack('<l', f.read(4))[0]
+            offset = c.tell()
+            i = c.read_i32()
             if i:
-                j = unpack('<l', f.read(4))[0]
+                j = c.read_i32()
 
                 # read data
-                V = chunk(unpack('<%if' % (i * 3), f.read(i * 12)), 3)
-                I = chunk(unpack('<%iH' % j, f.read(j * 2)), 3)
+                V = _read_array(c, '<f4', i * 3).reshape(i, 3)
+                I = _read_triangles(c, j)
                 dynamic_bmesh.append((V, I))
 
                 log_level > 1 and log('--Part # %02i @ %08x -> vertices: %i, indices: %i' % (k, offset, len(V), len(I)))
@@ -488,7 +642,7 @@ def _load_geometry_data(f, log_level):
     else:
         dynamic_bmesh = None
 
-    log_level and log('//// Finished @ %08x' % f.tell())
+    log_level and log('//// Finished @ %08x' % c.tell())
 
     return GeometryData(DATA_GROUPS, INDEX_GROUPS, inverse_transforms, MORPH_NAMES, static_bmesh, dynamic_bmesh)
 
@@ -498,39 +652,32 @@ def _load_geometry_data(f, log_level):
 def _rm_doubles(geometry):
     for idx1, g1 in enumerate(geometry.data_groups):
 
-        if g1.tex_coords:
+        if len(g1.tex_coords):
 
             log('Processing data group # %i...' % idx1)
 
-            N = g1.normals or repeat(0)
-            B = g1.bones or repeat(0)
-            W = g1.weights or repeat(0)
-            K = g1.keys or repeat(0)
-
             g1.mask = []  # remove deform mask
 
             # validate morph data
             #
-            i = sum(2 ** i for i, v in enumerate(g1.dVerts) if v)
-            j = sum(2 ** j for j, v in enumerate(g1.dNorms) if v)
-
-            assert i in (0, 1, 3, 7, 15) and (j == 0 or j == i) and (bool(i) == bool(g1.keys))
+            i = sum(2 ** i for i, v in enumerate(g1.dVerts) if len(v))
+            j = sum(2 ** j for j, v in enumerate(g1.dNorms) if len(v))
 
-            dV = zip(*filter(bool, g1.dVerts)) or repeat(0)
-            dN = zip(*filter(bool, g1.dNorms)) or repeat(0)
+            assert i in (0, 1, 3, 7, 15) and (j == 0 or j == i) and (bool(i) == bool(len(g1.keys)))
 
-            unique_verts = {}  # { vertex -> new_index }
-            indices = []  # indices[old_index] -> new_index
+            # vertex attributes (texture coords are not compared);
+            # bones, weights and keys may be tuples of variable length
+            w = g1.weights
+            k = w.shape[1] if isinstance(w, np.ndarray) else max(map(len, w)) if len(w) else 0
+            V = [g1.vertices, g1.normals, _align(g1.bones, 4, 0xff, np.uint8), _align(w, k, 0.0, np.float32),
+                 _align(g1.keys, 4, 0, np.uint8)]
+            V += [v for v in g1.dVerts if len(v)] + [v for v in g1.dNorms if len(v)]
 
             # search
-            for vertex in zip(g1.vertices, N, B, W, K, dV, dN):
-                k = unique_verts.setdefault(vertex, len(unique_verts))
-                indices.append(k)
+            first, indices = _unique_rows([v for v in V if len(v)])  # indices[old_index] -> new_index
             assert len(indices) == g1.count
 
-            unique_verts = [v for v, i in sorted(unique_verts.items(), key=lambda x: x[1])]
-
-            log('--Vertex count: %i -> %i' % (g1.count, len(unique_verts)))
+            log('--Vertex count: %i -> %i' % (g1.count, len(first)))
             log('--Updating data...')
 
             for idx2, g2 in enumerate(geometry.index_groups):
@@ -538,182 +685,551 @@ def _rm_doubles(geometry):
                 if g2.data_group_index == idx1:
                     log('\x20\x20--Processing index group # %i...' % idx2)
 
-                    I = g2.indices
+                    I = np.asarray(g2.indices).reshape(-1, 3)
 
                     # move texture coords to index group
-                    T = g1.tex_coords
-                    g2.tex_coords = [(T[i], T[j], T[k]) for i, j, k in I]
+                    g2.tex_coords = np.asarray(g1.tex_coords)[I]
 
                     # update indices
-                    g2.indices = [(indices[i], indices[j], indices[k]) for i, j, k in I]
+                    g2.indices = indices[I].astype(np.uint16)
 
-                    del T, I
+                    del I
 
-            g1.count = len(unique_verts)
+            g1.count = len(first)
             g1.tex_coords = []
             g1.tangents = []
 
-            g1.vertices, N, B, W, K, dV, dN = map(list, zip(*unique_verts));
-            del unique_verts, indices
+            g1.vertices = np.asarray(g1.vertices)[first]
+            if len(g1.normals): g1.normals = np.asarray(g1.normals)[first]
+            if len(g1.bones): g1.bones = V[2][first]
+            if len(g1.weights): g1.weights = V[3][first]
+            if len(g1.keys): g1.keys = V[4][first]
+
+            g1.dVerts = [np.asarray(v)[first] if len(v) else [] for v in g1.dVerts]
+            g1.dNorms = [np.asarray(v)[first] if len(v) else [] for v in g1.dNorms]
+
+            del V, first, indices
+
+
+def _bone_counts(bones):
+    if isinstance(bones, np.ndarray):
+        # bone indices are padded with 0xFF
+        return (bones != 0xff).cumprod(axis=1, dtype=np.uint8).sum(axis=1, dtype=np.uint8)
+    return np.array([len(b) for b in bones], np.uint8)
+
+
+def _unique_rows(arrays):
+    # compare rows of several arrays as raw bytes;
+    # returns (first_indices, inverse), new indices follow the order of first occurrence
+    rows = np.hstack([np.ascontiguousarray(v).view(np.uint8).reshape(len(v), -1) for v in map(np.asarray, arrays)])
+    rows = np.ascontiguousarray(rows).view(np.dtype((np.void, rows.shape[1]))).ravel()
+    _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return first[order], rank[inverse.ravel()]
+
+
+def _align(data, width, fill, dtype):
+    # (N, width) array from an array or a sequence of (variable-length) tuples
+    if isinstance(data, MappedArray):
+        data = np.asarray(data)
+    if isinstance(data, np.ndarray):
+        data = data[:, :width]
+        if data.shape[1] < width:
+            data = np.hstack([data, np.full((len(data), width - data.shape[1]), fill, data.dtype)])
+        return np.asarray(data, dtype)
+    # rows of a (N, max(width, longest tuple)) array are filled up to the
+    # length of each tuple, the rest is padding
+    n = np.fromiter(map(len, data), np.intp, len(data))
+    a = np.full((len(data), max(width, int(n.max())) if len(n) else width), fill, dtype)
+    a[np.arange(a.shape[1]) < n[:, None]] = np.fromiter(chain.from_iterable(data), dtype, int(n.sum()))
+    return a[:, :width]
+
+
+def _triangles(indices):
+    # (T, 3) uint16 array from an array or a sequence of 3-tuples; casting
+    # indices out of range would silently wrap them around
+    a = indices if isinstance(indices, np.ndarray) else np.asarray(indices, np.int32)
+    if a.dtype != np.uint16 and a.size and (a.min() < 0 or a.max() > 0xffff):
+        raise ValueError('Vertex index out of range (0..65535): %i' % (a.max() if a.min() >= 0 else a.min()))
+    return a.astype('<u2').reshape(-1, 3)
 
-            if g1.normals: g1.normals = N
-            if g1.bones: g1.bones = B
-            if g1.weights: g1.weights = W
-            if g1.keys: g1.keys = K
 
-            i = len(filter(bool, g1.dVerts))
-            j = len(filter(bool, g1.dNorms))
+# <- data_groups
 
-            if i: dV = map(list, zip(*dV)) + [[], [], []]; g1.dVerts = dV[:4]
-            if j: dN = map(list, zip(*dN)) + [[], [], []]; g1.dNorms = dN[:4]
 
-            del N, B, W, K, dV, dN
+########################################
+##  Probe
+########################################
 
+class GeometryInfo(object):
+    # summary of a GMDC file, as returned by probe_gmdc()
 
-# <- data_groups
+    def __init__(self, filename):
+        self.filename = filename
+        self.sg_resource_name = None
+        self.sections = []  # [(type, sub_index, element_count)]; type is None for empty/ignored sections
+        self.data_groups = []  # [element_count]
+        self.index_groups = []  # [(name, triangle_count)]
+        self.bone_count = 0
+        self.morph_names = []
+        self.static_bmesh = False
+        self.dynamic_bmesh = 0  # number of non-empty parts
+
+    def __str__(self):
+        s = 'GeometryInfo\n'
+        s += '--Filename: "%s"\n' % self.filename
+        s += '--SGResource: "%s"\n' % self.sg_resource_name
+        s += '--Sections (%i): ' % len(self.sections)
+        s += '\x20'.join('%s%s(%i)' % (t, i or '', n) if t else '-' for t, i, n in self.sections) + '\n'
+        s += '--Data groups (%i): ' % len(self.data_groups) + str(self.data_groups) + '\n'
+        s += '--Index groups (%i):\n' % len(self.index_groups)
+        s += "".join('\x20\x20"%s", triangles: %i\n' % t for t in self.index_groups)
+        s += '--Bones: %i\n' % self.bone_count
+        s += '--Morphs: ' + str(self.morph_names) + '\n'
+        s += '--Bounding geometry: static: %s, dynamic: %i' % (self.static_bmesh, self.dynamic_bmesh)
+        return s
+
+    def __repr__(self):
+        return self.__str__()
+
+
+def probe_gmdc(filename):
+    # reads only headers, names and counts; payloads are skipped using
+    # the size fields, so only a few pages of the file are touched
+
+    with open(filename, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            error('Error! File is empty.')
+            return False
+        f = mmap(f.fileno(), 0, access=ACCESS_READ)
+
+    c = Cursor(f)
+
+    try:
+        if not _seek_geometry_data(c):
+            return False
+
+        info = GeometryInfo(filename)
+        info.sg_resource_name = c.read_str()
+        _probe_geometry_data(c, info)
+
+    finally:
+        f.close()
+
+    return info
+
+
+def _probe_geometry_data(c, info):
+    # fills in info from the geometry data at the cursor (after the
+    # resource name) and moves the cursor past it
+
+    # sections
+    for section in _read_section_table(c, 0):
+        info.sections.append((section.type, section.sub_index, section.count) if section else (None, None, 0))
+
+    # groups
+    for k in xrange(c.read_i32()):
+        i = c.read_i32()
+        c.skip(i * 2)
+        info.data_groups.append(c.read_i32())
+        c.skip(4)
+        for j in xrange(3):  # index mapping
+            i = c.read_i32()
+            c.skip(i * 2)
+
+    # index groups
+    for k in xrange(c.read_i32()):
+        c.skip(8)
+        name = c.read_str()
+        i = c.read_i32()
+        c.skip(i * 2 + 4)  # indices, flags
+        info.index_groups.append((name, i // 3))
+        i = c.read_i32()
+        c.skip(i * 2)
+
+    # inverse transforms
+    info.bone_count = c.read_i32()
+    c.skip(info.bone_count * 28)
+
+    # morphs
+    for k in xrange(c.read_i32()):
+        info.morph_names.append((c.read_str(), c.read_str()))
+
+    # bounding geometry
+    i = c.read_i32()
+    if i:
+        j = c.read_i32()
+        c.skip(i * 12 + j * 2)
+        info.static_bmesh = True
+    for k in xrange(c.read_i32()):
+        i = c.read_i32()
+        if i:
+            j = c.read_i32()
+            c.skip(i * 12 + j * 2)
+            info.dynamic_bmesh += 1
+
+
+def _seek_geometry_data(c):
+    # skips file and node headers up to the resource name
+
+    s = c.read(4)
+    if s != b'\x01\x00\xff\xff':
+        error('Error! Wrong file header:', to_hex(s))
+        return False
+
+    # linked resources
+    i = c.read_i32()
+    c.skip(i * 16)
+
+    # types of nodes
+    i = c.read_i32()
+    s = c.read(i * 4)
+    if s[:4] != b'\x87\x86\x4F\xAC':
+        error('Error! Not a GMDC file.')
+        return False
+
+    if not c.expect_header(b'\x16cGeometryDataContainer\x87\x86\x4F\xAC', 'cGeometryDataContainer'):
+        return False
+    c.skip(4)  # version
+    if not c.expect_header(b'\x0bcSGResource\x00\x00\x00\x00\x02\x00\x00\x00', 'cSGResource'):
+        return False
+
+    return True
+
+
+########################################
+##  Patch
+########################################
+
+def patch_gmdc_section(filename, group_index, name, data, sub_index=0):
+    # overwrites the payload of one section of a GMDC file in place;
+    # name - attribute of the data group ('vertices', 'normals', ...,
+    # 'dVerts', 'dNorms' - sub_index is the number of the morph).
+    # element and component counts of data must be those of the section.
+    # other groups that share the section see the new data as well.
+
+    with open(filename, 'r+b') as f:
+        if not os.fstat(f.fileno()).st_size:
+            error('Error! File is empty.')
+            return False
+        f = mmap(f.fileno(), 0, access=ACCESS_WRITE)
+
+    c = Cursor(f)
+
+    try:
+        if not _seek_geometry_data(c):
+            return False
+        c.skip(c.read_u8())  # resource name
+
+        SECTIONS = _read_section_table(c, 0)
+
+        # section indices of the group
+        group_count = c.read_i32()
+        if not 0 <= group_index < group_count:
+            error('Error! Group index is out of range: %i (groups: %i)' % (group_index, group_count))
+            return False
+        for k in xrange(group_index + 1):
+            indices = c.read_u16_array(c.read_i32())
+            c.skip(8)
+            for j in xrange(3):  # index mapping
+                c.skip(c.read_i32() * 2)
+
+        section = _find_section([SECTIONS[i] for i in indices], name, sub_index)
+        if not section:
+            error('Error! Group %i has no section "%s" (sub index: %i).' % (group_index, name, sub_index))
+            return False
+
+        data = np.asarray(data, section.dtype)
+        if data.shape != (section.count, section.cc):
+            error('Error! Data does not match the section: %s (section: %i x %i)' % (
+                'x'.join(map(str, data.shape)), section.count, section.cc))
+            return False
+
+        f[section.offset:section.offset + data.nbytes] = data.tobytes()
+        f.flush()
+
+    finally:
+        f.close()
+
+    return True
+
+
+def _find_section(sections, name, sub_index):
+    # section of a data group attribute (as assigned in _load_geometry_data)
+    if name in ('dVerts', 'dNorms'):
+        type = 'dV' if name == 'dVerts' else 'dN'
+        v = [s for s in sections if s and s.type == type and s.sub_index == sub_index]
+    else:
+        attr = 'tex_coords' if name == 'tex_coords2' else name
+        v = [s for s in sections if s and _GROUP_ATTRS.get(s.type) == attr]
+        v = v[1:] if name == 'tex_coords2' else v
+    return v[0] if v else None
 
 
 ########################################
 ##  Exporter
 ########################################
 
-def create_gmdc_file(filename, sg_resource_name, geometry):
+def create_gmdc_file(filename, sg_resource_name, geometry, optimize=False):
+    # without optimize, sections are written in chunks of rows straight
+    # from the data groups (see GMDCWriter) - neither the file nor the
+    # aligned arrays are built in memory as a whole
+
+    if optimize:
+        data = serialize_gmdc(sg_resource_name, geometry, optimize)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return
+
+    with GMDCWriter(filename, sg_resource_name) as w:
+        group_section_indices = []
+        for group in geometry.data_groups:
+            group_section_indices.append([w.write_section(type, _row_chunks(data), sub_index, width)
+                                          for type, sub_index, data, width in _group_sections(group)])
+        for indices, group in zip(group_section_indices, geometry.data_groups):
+            w.add_data_group(indices, len(group.vertices))
+        for group in geometry.index_groups:
+            w.write_index_group(group.name, group.data_group_index, _row_chunks(_triangles(group.indices)),
+                                group.flags, group.bones)
+        w.close(geometry.inverse_transforms, geometry.morph_names, geometry.static_bmesh, geometry.dynamic_bmesh)
+
+
+_CHUNK_ROWS = 1 << 14
+
+
+def _row_chunks(data):
+    # slices of up to _CHUNK_ROWS rows of an array or a sequence of tuples
+    for i in xrange(0, len(data), _CHUNK_ROWS):
+        yield data[i:i + _CHUNK_ROWS]
+
+
+def serialize_gmdc(sg_resource_name, geometry, optimize=False):
+    # GMDC file as bytes; the layout is computed first,
+    # then the file is built in a single preallocated buffer.
+    # optimize - share identical sections between data groups and
+    # store repeated vertices / normals / texture coords once, with
+    # index mappings (in groups without rigging and morphs)
+
     node = GeometryDataContainer(0)
     node.sg_resource_name = sg_resource_name
-    node.geometry = geometry
 
-    with open(filename, 'wb') as f:
-        f.write(b'\x01\x00\xff\xff\x00\x00\x00\x00\x01\x00\x00\x00\x87\x86\x4F\xAC')
-        node.write(f)
+    f = BytesIO()
+    f.write(b'\x01\x00\xff\xff\x00\x00\x00\x00\x01\x00\x00\x00\x87\x86\x4F\xAC')
+    node._write_header(f)
 
-    del node
+    return bytes(_serialize_geometry_data(geometry, f.getvalue(), optimize))
 
 
-def _write_geometry_data(f, geometry):
-    #
-    # build sections
-    #
+def _serialize_geometry_data(geometry, head=b'', optimize=False):
+    # bytearray - head + geometry data
+    layout = _GeometryLayout(geometry, optimize)
+    buf = bytearray(len(head) + layout.size)
+    buf[:len(head)] = head
+    f = _BufferWriter(buf, len(head))
+    _write_geometry_data(f, geometry, layout)
+    assert f.pos == len(buf)
+    return buf
+
+
+class _BufferWriter(object):
+    # file-like writer into a preallocated bytearray;
+    # arrays are copied in place, without intermediate bytes
+
+    def __init__(self, buf, pos=0):
+        self.buf = buf
+        self.view = np.frombuffer(buf, np.uint8)
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def write(self, s):
+        i = self.pos
+        if isinstance(s, np.ndarray):
+            self.pos += s.nbytes
+            self.view[i:self.pos] = np.ascontiguousarray(s).view(np.uint8).reshape(-1)
+        else:
+            self.pos += len(s)
+            self.buf[i:self.pos] = s
+
+
+_SECTION_MAGIC = {
+    'V': b'\x81\x07\x83\x5B',
+    'N': b'\x8B\x07\x83\x3B',
+    'T': b'\xAB\x07\x83\xBB',
+    'B': b'\x11\x01\xD7\xFB',
+    'W': b'\x05\x01\xD7\x3B',
+    'X': b'\xA0\x2B\xD9\x89',
+    'dV': b'\xE1\xCF\xF2\x5C',
+    'dN': b'\x6A\x3A\x6F\xCB',
+    'K': b'\xDC\xCF\xF2\xDC',
+    'M': b'\x95\x07\x83\xDB',
+}
+
+
+class _GeometryLayout(object):
+    # normalized (little-endian) arrays of a GeometryData to be written,
+    # and the size of the serialized data
+
+    def __init__(self, geometry, optimize=False):
+        self.sections, self.group_section_indices = _build_sections(geometry)
+        self.group_mappings = [(_NO_MAPPING,) * 3] * len(self.group_section_indices)
+        if optimize:
+            self.sections, self.group_section_indices, self.group_mappings = _share_sections(
+                geometry, self.sections, self.group_section_indices)
+        self.triangles = [_triangles(group.indices) for group in geometry.index_groups]
+
+        self.static_bmesh = None
+        if geometry.static_bmesh and len(geometry.static_bmesh[0]):
+            self.static_bmesh = _bmesh(*geometry.static_bmesh)
+        self.dynamic_bmesh = geometry.dynamic_bmesh and [part and _bmesh(*part) for part in geometry.dynamic_bmesh]
+
+        # sections
+        i = 4 + sum(28 + data.nbytes for type, sub_index, data in self.sections)
+
+        # groups
+        i += 4 + sum(24 + 2 * len(t) for t in self.group_section_indices)
+        i += sum(m.nbytes for v in self.group_mappings for m in v)
+
+        # index groups
+        i += 4
+        for group, I in zip(geometry.index_groups, self.triangles):
+            i += 21 + len(group.name.encode('latin_1')) + I.nbytes + 2 * len(group.bones or ())
+
+        # inverse transforms, morphs
+        i += 4 + 28 * len(geometry.inverse_transforms or ())
+        i += 4 + sum(2 + len(a.encode('latin_1')) + len(b.encode('latin_1')) for a, b in geometry.morph_names or ())
+
+        # bounding geometry
+        i += 8 + sum(a.nbytes for a in self.static_bmesh) if self.static_bmesh else 4
+        i += 4 + sum(8 + sum(a.nbytes for a in part) if part else 4 for part in self.dynamic_bmesh or ())
+
+        self.size = i
+
+
+def _bmesh(V, I):
+    return np.asarray(V, '<f4').reshape(-1, 3), _triangles(I)
+
+
+def _group_sections(group):
+    # [(type, sub_index, data, width)] - sections of a data group,
+    # data as stored in the group (rows are aligned to width when written)
+
+    v = [('V', 0, group.vertices, 3)]
+    if len(group.normals):
+        v.append(('N', 0, group.normals, 3))
+    if len(group.tex_coords):
+        v.append(('T', 0, group.tex_coords, 2))
+        if len(group.tex_coords2):
+            v.append(('T', 1, group.tex_coords2, 2))
+
+    if len(group.bones):
+        v.append(('B', 0, group.bones, 4))
+        # bone weight tuples (length <= 3)
+        w = group.weights
+        v.append(('W', 0, w, min(3, w.shape[1] if isinstance(w, np.ndarray) else max(map(len, w)))))
+
+    if len(group.tangents):
+        v.append(('X', 0, group.tangents, 3))
+
+    if len(group.keys):
+        v.append(('K', 0, group.keys, 4))
+
+        # validate morph data
+        i = sum(2 ** i for i, x in enumerate(group.dVerts) if len(x))
+        j = sum(2 ** j for j, x in enumerate(group.dNorms) if len(x))
+
+        assert i in (1, 3, 7, 15) and (j == 0 or j == i)
+
+        v += [('dV', i, x, 3) for i, x in enumerate(group.dVerts) if len(x)]
+        v += [('dN', i, x, 3) for i, x in enumerate(group.dNorms) if len(x)]
+
+    if len(group.mask):
+        v.append(('M', 0, group.mask, 4))
+
+    return v
+
+
+def _align_section(type, data, width):
+    if type in ('B', 'K', 'M'):
+        return _align(data, width, 0xff if type == 'B' else 0, np.uint8)
+    return _align(data, width, 0.0, '<f4')
+
+
+def _build_sections(geometry):
+    # returns [(type, sub_index, data)], [group_index] -> (section_indices)
 
     SECTIONS = []
 
     group_section_indices = []  # [group_index] -> (section_indices)
 
     for group in geometry.data_groups:
-        indices = [len(SECTIONS)]
-        SECTIONS.append(('V', 0, group.vertices))
-        if group.normals:
-            indices.append(len(SECTIONS))
-            SECTIONS.append(('N', 0, group.normals))
-        if group.tex_coords:
-            indices.append(len(SECTIONS))
-            SECTIONS.append(('T', 0, group.tex_coords))
-            if group.tex_coords2:
-                indices.append(len(SECTIONS))
-                SECTIONS.append(('T', 1, group.tex_coords2))
-
-        if group.bones:
-            i = len(SECTIONS)
-            indices += [i, i + 1]
-
-            # align bone index tuples
-            v = [(b + (0xff, 0xff, 0xff, 0xff))[:4] for b in group.bones]
-            SECTIONS.append(('B', 0, v))
-
-            # align bone weight tuples (length <= 3)
-            k = min(3, max(map(len, group.weights)))
-            v = [(w + (0.0, 0.0, 0.0))[:k] for w in group.weights]
-            SECTIONS.append(('W', 0, v))
-
-        if group.tangents:
-            indices.append(len(SECTIONS))
-            SECTIONS.append(('X', 0, group.tangents))
-
-        if group.keys:
-            # keys
-            indices.append(len(SECTIONS))
-            # get aligned key index tuples
-            v = [(k + (0, 0, 0, 0))[:4] for k in group.keys]
-            SECTIONS.append(('K', 0, v))
+        v = _group_sections(group)
+        group_section_indices.append(tuple(xrange(len(SECTIONS), len(SECTIONS) + len(v))))
+        SECTIONS += [(type, sub_index, _align_section(type, data, width)) for type, sub_index, data, width in v]
 
-            # validate morph data
-            i = sum(2 ** i for i, v in enumerate(group.dVerts) if v)
-            j = sum(2 ** j for j, v in enumerate(group.dNorms) if v)
+    return SECTIONS, group_section_indices
 
-            assert i in (1, 3, 7, 15) and (j == 0 or j == i)
 
-            # dVerts
-            k = sum(map(bool, group.dVerts))
-            i = len(SECTIONS)
-            indices += range(i, i + k)
-            for i in xrange(k):
-                SECTIONS.append(('dV', i, group.dVerts[i]))
+_NO_MAPPING = np.zeros(0, '<u2')
 
-            # dNorms
-            k = sum(map(bool, group.dNorms))
-            i = len(SECTIONS)
-            indices += range(i, i + k)
-            for i in xrange(k):
-                SECTIONS.append(('dN', i, group.dNorms[i]))
 
-        if group.mask:
-            indices.append(len(SECTIONS))
-            SECTIONS.append(('M', 0, group.mask))
+def _share_sections(geometry, sections, group_section_indices):
+    # returns optimized sections, section indices and index mappings:
+    # vertices, normals and texture coords of groups without rigging
+    # and morphs are reduced to unique rows + index mapping (if this
+    # saves space); identical sections are written once and shared
 
-        group_section_indices.append(tuple(indices))
+    SECTIONS = []
+    found = {}  # { (type, sub_index, shape, digest) -> section index }
 
-    #
-    # write sections
-    #
+    new_indices = []
+    mappings = []
 
-    f.write(pack('<l', len(SECTIONS)))  # number of sections
-
-    for type, sub_index, data in SECTIONS:
-
-        s = pack('<l', len(data))  # number of elements
-        cc = len(data[0])  # component count
-
-        # magic number
-        if type == 'V':
-            s += b'\x81\x07\x83\x5B'
-        elif type == 'N':
-            s += b'\x8B\x07\x83\x3B'
-        elif type == 'T':
-            s += b'\xAB\x07\x83\xBB'
-        elif type == 'B':
-            s += b'\x11\x01\xD7\xFB'
-        elif type == 'W':
-            s += b'\x05\x01\xD7\x3B'
-        elif type == 'X':
-            s += b'\xA0\x2B\xD9\x89'
-        elif type == 'dV':
-            s += b'\xE1\xCF\xF2\x5C'
-        elif type == 'dN':
-            s += b'\x6A\x3A\x6F\xCB'
-        elif type == 'K':
-            s += b'\xDC\xCF\xF2\xDC'
-        elif type == 'M':
-            s += b'\x95\x07\x83\xDB'
-
-        s += pack('<l', sub_index)
-
-        if type in ('B', 'K', 'M'):
-            s += b'\x04\x00\x00\x00'  # 4 bytes
-            s += b'\x03\x00\x00\x00'  # unknown
-            s += pack('<l', len(data) * 4)  # size in bytes
-            fmt = '4B'
-        else:
-            s += pack('<l', cc - 1)  # floats (1, 2 or 3)
-            s += b'\x03\x00\x00\x00'  # unknown
-            s += pack('<l', len(data) * 4 * cc)  # size in bytes
-            fmt = '<%if' % cc
+    for group, indices in zip(geometry.data_groups, group_section_indices):
+        mappable = not (len(group.bones) or len(group.keys))
+        m = {}  # { type -> index mapping }
+        t = []
 
-        # header
-        f.write(s)
+        for i in indices:
+            type, sub_index, data = sections[i]
 
-        # data
-        for t in data:
-            f.write(pack(fmt, *t))
+            if mappable and type in ('V', 'N', 'T') and sub_index == 0 and type not in m:
+                first, inverse = _unique_rows([data])
+                # rows saved vs. size of the mapping (of uint16 row indices)
+                if (len(data) - len(first)) * data.shape[1] * 4 > 2 * len(data) and len(first) <= 0x10000:
+                    data = data[first]
+                    m[type] = inverse.astype('<u2')
 
+            data = np.ascontiguousarray(data)
+            key = (type, sub_index, data.shape, hashlib.sha1(data).digest())
+            i = found.get(key)
+            if i is None:
+                i = found[key] = len(SECTIONS)
+                SECTIONS.append((type, sub_index, data))
+            t.append(i)
+
+        new_indices.append(tuple(t))
+        mappings.append(tuple(m.get(type, _NO_MAPPING) for type in ('V', 'N', 'T')))
+
+    return SECTIONS, new_indices, mappings
+
+
+
+def _write_geometry_data(f, geometry, layout):
+    # f - _BufferWriter; layout - _GeometryLayout of geometry
+
+    #
+    # sections
+    #
+
+    f.write(pack('<l', len(layout.sections)))  # number of sections
+
+    for type, sub_index, data in layout.sections:
+        f.write(_section_header(type, sub_index, len(data), data.shape[1]))
+        f.write(data)
         f.write(b'\x00\x00\x00\x00')  # no indices
 
     #
@@ -721,14 +1237,10 @@ def _write_geometry_data(f, geometry):
     #
 
     # number of groups
-    f.write(pack('<l', len(group_section_indices)))
+    f.write(pack('<l', len(layout.group_section_indices)))
 
-    for t, group in zip(group_section_indices, geometry.data_groups):
-        f.write(pack('<l', len(t)))  # number of sections
-        f.write(pack('<%iH' % len(t), *t))  # section indices
-        f.write(pack('<l', len(group.vertices)))  # number of elements in section
-        f.write(pack('<l', len(t)))  # again number of sections (?)
-        f.write(b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00')  # no index mapping
+    for t, m, group in zip(layout.group_section_indices, layout.group_mappings, geometry.data_groups):
+        _write_data_group(f, t, len(group.vertices), m)
 
     #
     # indices
@@ -737,38 +1249,72 @@ def _write_geometry_data(f, geometry):
     # number of index groups
     f.write(pack('<l', len(geometry.index_groups)))
 
-    for group in geometry.index_groups:
+    for group, I in zip(geometry.index_groups, layout.triangles):
         f.write(b'\x02\x00\x00\x00')  # triangles
         f.write(pack('<l', group.data_group_index))
         write_str(f, group.name)
-        f.write(pack('<l', len(group.indices) * 3))
+        f.write(pack('<l', len(I) * 3))
+        f.write(I)
+        _write_index_group_bones(f, group.flags, group.bones)
 
-        for t in group.indices:
-            f.write(pack('<3H', *t))
+    _write_extras(f, geometry.inverse_transforms, geometry.morph_names, layout.static_bmesh, layout.dynamic_bmesh)
 
-        f.write(pack('<L', group.flags))
 
-        if group.bones:
-            f.write(pack('<l%iH' % len(group.bones), len(group.bones), *group.bones))
-        else:
-            f.write(b'\x00\x00\x00\x00')  # no bones
+def _section_header(type, sub_index, count, cc):
+    s = pack('<l', count)  # number of elements
+    s += _SECTION_MAGIC[type]  # magic number
+    s += pack('<l', sub_index)
+
+    if type in ('B', 'K', 'M'):
+        s += b'\x04\x00\x00\x00'  # 4 bytes
+        s += b'\x03\x00\x00\x00'  # unknown
+        s += pack('<l', count * 4)  # size in bytes
+    else:
+        s += pack('<l', cc - 1)  # floats (1, 2 or 3)
+        s += b'\x03\x00\x00\x00'  # unknown
+        s += pack('<l', count * 4 * cc)  # size in bytes
+
+    return s
+
+
+def _write_data_group(f, indices, count, mappings):
+    f.write(pack('<l', len(indices)))  # number of sections
+    f.write(pack('<%iH' % len(indices), *indices))  # section indices
+    f.write(pack('<l', count))  # number of elements in section
+    f.write(pack('<l', len(indices)))  # again number of sections (?)
+    for mapping in mappings:  # index mappings (vertices, normals, texture coords)
+        f.write(pack('<l', len(mapping)))
+        f.write(mapping)
+
+
+def _write_index_group_bones(f, flags, bones):
+    f.write(pack('<L', flags))
+
+    if bones:
+        f.write(pack('<l%iH' % len(bones), len(bones), *bones))
+    else:
+        f.write(b'\x00\x00\x00\x00')  # no bones
+
+
+def _write_extras(f, inverse_transforms, morph_names, static_bmesh, dynamic_bmesh):
+    # bounding meshes - as normalized by _bmesh()
 
     #
     # inverse transforms
     #
 
-    if geometry.inverse_transforms:
-        f.write(pack('<l', len(geometry.inverse_transforms)))
-        for t in geometry.inverse_transforms:
-            f.write(pack('<7f', *(t[0] + t[1])))
+    if inverse_transforms:
+        f.write(pack('<l', len(inverse_transforms)))
+        for t in inverse_transforms:
+            f.write(pack('<7f', *(tuple(t[0]) + tuple(t[1]))))
     else:
         f.write(b'\x00\x00\x00\x00')  # no transforms (static mesh)
 
     # morph names
 
-    if geometry.morph_names:
-        f.write(pack('<l', len(geometry.morph_names)))
-        for name in geometry.morph_names:
+    if morph_names:
+        f.write(pack('<l', len(morph_names)))
+        for name in morph_names:
             write_str(f, name[0])
             write_str(f, name[1])
     else:
@@ -780,35 +1326,172 @@ def _write_geometry_data(f, geometry):
 
     # static
 
-    if geometry.static_bmesh and geometry.static_bmesh[0]:
-        V, I = geometry.static_bmesh
+    if static_bmesh:
+        V, I = static_bmesh
         f.write(pack('<l', len(V)))
         f.write(pack('<l', len(I) * 3))
-
-        for t in V:
-            f.write(pack('<3f', *t))
-
-        for t in I:
-            f.write(pack('<3H', *t))
+        f.write(V)
+        f.write(I)
     else:
         f.write(b'\x00\x00\x00\x00')
 
     # dynamic
 
-    if geometry.dynamic_bmesh:
-        f.write(pack('<l', len(geometry.dynamic_bmesh)))
-        for part in geometry.dynamic_bmesh:
+    if dynamic_bmesh:
+        f.write(pack('<l', len(dynamic_bmesh)))
+        for part in dynamic_bmesh:
             if part:
                 V, I = part
                 f.write(pack('<l', len(V)))
                 f.write(pack('<l', len(I) * 3))
-
-                for t in V:
-                    f.write(pack('<3f', *t))
-
-                for t in I:
-                    f.write(pack('<3H', *t))
+                f.write(V)
+                f.write(I)
             else:
                 f.write(b'\x00\x00\x00\x00')
     else:
         f.write(b'\x00\x00\x00\x00')
+
+
+########################################
+##  Streaming writer
+########################################
+
+class GMDCWriter(object):
+    # writes a GMDC file section by section; section payloads and
+    # triangle lists are taken from iterables of chunks (arrays or
+    # sequences of tuples) and written as they come, element counts
+    # and sizes are filled in when a section / index group is finished.
+    #
+    #   w = GMDCWriter(filename, sg_resource_name)
+    #   i = w.write_section('V', vertex_chunks)  # -> section index
+    #   ...                                       # (all sections first)
+    #   w.add_data_group([i, ...])
+    #   w.write_index_group(name, data_group_index, triangle_chunks)
+    #   w.close(inverse_transforms, morph_names, static_bmesh, dynamic_bmesh)
+    #
+    # the file must be seekable. index mappings are not written. used as a
+    # context manager, the file is closed on exit (removed, if the block fails).
+
+    def __init__(self, filename, sg_resource_name):
+        node = GeometryDataContainer(0)
+        node.sg_resource_name = sg_resource_name
+
+        self.filename = filename
+        self.f = f = open(filename, 'wb')
+        f.write(b'\x01\x00\xff\xff\x00\x00\x00\x00\x01\x00\x00\x00\x87\x86\x4F\xAC')
+        node._write_header(f)
+
+        self.section_counts = []  # element count of each section
+        self.data_groups = []  # [(section_indices, count)]
+        self.index_group_count = 0
+
+        self._sections_offset = f.tell()
+        f.write(b'\x00\x00\x00\x00')  # number of sections (filled in by close())
+        self._index_groups_offset = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        elif not self.f.closed:
+            # incomplete - not left on disk
+            self.f.close()
+            os.remove(self.filename)
+
+    def write_section(self, type, chunks, sub_index=0, cc=None):
+        # type - 'V', 'N', 'T', 'B', 'W', 'X', 'dV', 'dN', 'K' or 'M';
+        # cc - component count of float data (default: 3, 2 for 'T');
+        # bone indices and keys are padded to 4 bytes
+        assert not self.data_groups and self._index_groups_offset is None, 'sections must be written first'
+
+        f = self.f
+        offset = f.tell()
+        f.write(_section_header(type, sub_index, 0, 1))
+
+        uint8 = type in ('B', 'K', 'M')
+        if uint8:
+            cc = 4
+        elif not cc:
+            cc = 2 if type == 'T' else 3
+
+        count = 0
+        for chunk in chunks:
+            a = _align_section(type, chunk, cc)
+            f.write(np.ascontiguousarray(a))  # column slices are not
+            count += len(a)
+
+        f.write(b'\x00\x00\x00\x00')  # no indices
+
+        end = f.tell()
+        f.seek(offset)
+        f.write(_section_header(type, sub_index, count, cc))
+        f.seek(end)
+
+        self.section_counts.append(count)
+        return len(self.section_counts) - 1
+
+    def add_data_group(self, section_indices, count=None):
+        # count - number of elements (default: that of the first section);
+        # returns the index of the group
+        assert self._index_groups_offset is None, 'data groups must be added before index groups'
+        if count is None:
+            count = self.section_counts[section_indices[0]]
+        self.data_groups.append((tuple(section_indices), count))
+        return len(self.data_groups) - 1
+
+    def _end_data_groups(self):
+        f = self.f
+        f.write(pack('<l', len(self.data_groups)))
+        for indices, count in self.data_groups:
+            _write_data_group(f, indices, count, (_NO_MAPPING,) * 3)
+        self._index_groups_offset = f.tell()
+        f.write(b'\x00\x00\x00\x00')  # number of index groups (filled in by close())
+
+    def write_index_group(self, name, data_group_index, chunks, flags=0xffffffff, bones=None):
+        # chunks - triangles ((T, 3) arrays or sequences of 3-tuples)
+        if self._index_groups_offset is None:
+            self._end_data_groups()
+
+        f = self.f
+        f.write(b'\x02\x00\x00\x00')  # triangles
+        f.write(pack('<l', data_group_index))
+        write_str(f, name)
+
+        offset = f.tell()
+        f.write(b'\x00\x00\x00\x00')
+        count = 0
+        for chunk in chunks:
+            a = _triangles(chunk)
+            f.write(np.ascontiguousarray(a))
+            count += len(a)
+
+        end = f.tell()
+        f.seek(offset)
+        f.write(pack('<l', count * 3))
+        f.seek(end)
+
+        _write_index_group_bones(f, flags, bones)
+        self.index_group_count += 1
+
+    def close(self, inverse_transforms=None, morph_names=None, static_bmesh=None, dynamic_bmesh=None):
+        # (does nothing if the file is closed already)
+        if self.f.closed:
+            return
+        if self._index_groups_offset is None:
+            self._end_data_groups()
+
+        f = self.f
+        if static_bmesh and len(static_bmesh[0]):
+            static_bmesh = _bmesh(*static_bmesh)
+        else:
+            static_bmesh = None
+        dynamic_bmesh = dynamic_bmesh and [part and _bmesh(*part) for part in dynamic_bmesh]
+        _write_extras(f, inverse_transforms, morph_names, static_bmesh, dynamic_bmesh)
+
+        f.seek(self._sections_offset)
+        f.write(pack('<l', len(self.section_counts)))
+        f.seek(self._index_groups_offset)
+        f.write(pack('<l', self.index_group_count))
+        f.close()
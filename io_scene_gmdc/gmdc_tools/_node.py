@@ -20,9 +20,47 @@
 # THE SOFTWARE.
 # -------------------------------------------------------------------------------
 
-from struct import pack, unpack
+from struct import pack, Struct
 from ._common import *
 
+_BBl = Struct('<BBl')  # node reference
+_TRANSFORM = Struct('<3f4fl')  # location, rotation, bone index
+
+
+class _TrackedList(list):
+    # list property of a loaded node (e.g. child_nodes, or a list within
+    # Ext_data); changing it in place marks the node as modified
+
+    def __init__(self, node, items):
+        list.__init__(self, items)
+        self._node = node
+
+
+def _changing(method):
+    def f(self, *args):
+        node = getattr(self, '_node', None)  # (not set while unpickled)
+        if node is not None: node.mark_dirty()
+        return method(self, *args)
+
+    f.__name__ = method.__name__
+    return f
+
+
+for _name in ('append', 'extend', 'insert', 'remove', 'pop', 'clear', 'sort', 'reverse', '__setitem__',
+              '__delitem__', '__iadd__', '__imul__', '__setslice__', '__delslice__'):
+    if hasattr(list, _name):
+        setattr(_TrackedList, _name, _changing(getattr(list, _name)))
+del _name
+
+
+def _tracked(v, node):
+    # v with its lists (also those nested in tuples) replaced by _TrackedList
+    if isinstance(v, list):
+        return _TrackedList(node, [_tracked(x, node) for x in v])
+    if isinstance(v, tuple) and any(isinstance(x, (list, tuple)) for x in v):
+        return tuple(_tracked(x, node) for x in v)
+    return v
+
 
 ########################################
 #  Base node class
@@ -79,18 +117,41 @@ class _SGNode(object):
     # - geometry
     #
 
+    _span = None  # (start, end) of the node in the loaded file, while unmodified
+    _keep_raw = True  # False - the node is always written anew
+
     def __init__(self, index):
         self.index = index
         self.type = None
 
+    def __setattr__(self, name, value):
+        # assigning a property marks the node as modified
+        if name[0] != '_': self.__dict__['_span'] = None
+        self.__dict__[name] = value
+
+    def mark_dirty(self):
+        self._span = None
+
+    def _set_span(self, span):
+        # span - (start, end) of the node just read; list properties are
+        # tracked, so that changing them in place (e.g. extensions.append(...))
+        # marks the node as modified as well
+        self._span = span
+        for name, v in list(self.__dict__.items()):
+            if name[0] != '_' and isinstance(v, (list, tuple)):
+                self.__dict__[name] = _tracked(v, self)
+
+    def _get_span(self):
+        return self._span
+
     def __str__(self):
         return 'unknown'
 
     def __repr__(self):
         return self.__str__()
 
-    def _read_check_version(self, f, supported):
-        self.version = unpack('<l', f.read(4))[0]
+    def _read_check_version(self, c, supported):
+        self.version = c.read_i32()
         try:
             assert self.version == supported or self.version in supported
             b = True
@@ -102,91 +163,106 @@ class _SGNode(object):
     def _write_version(self, f):
         f.write(pack('<l', self.version))
 
-    # _read_-methods
+    # _read_-methods (c - Cursor)
 
-    def _read_csgresource(self, f):
-        s = f.read(20)
-        if s != b'\x0bcSGResource\x00\x00\x00\x00\x02\x00\x00\x00':
-            error('Error! cSGResource header:', to_hex(s))
-            error('%#x' % f.tell())
+    def _read_csgresource(self, c):
+        if not c.expect_header(b'\x0bcSGResource\x00\x00\x00\x00\x02\x00\x00\x00', 'cSGResource'):
             return False
-        self.sg_resource_name = read_str(f)
+        self.sg_resource_name = c.read_str()
         return True
 
-    def _read_ccompositiontreenode(self, f):
-        s = f.read(29)
-        if s != b'\x14cCompositionTreeNode\x00\x00\x00\x00\x0b\x00\x00\x00':
-            error('Error! cCompositionTreeNode header:', to_hex(s))
-            error('%#x' % f.tell())
+    def _read_ccompositiontreenode(self, c):
+        if not c.expect_header(b'\x14cCompositionTreeNode\x00\x00\x00\x00\x0b\x00\x00\x00', 'cCompositionTreeNode'):
             return False
-        if not self._read_cobjectgraphnode(f):
+        if not self._read_cobjectgraphnode(c):
             return False
-        i = unpack('<l', f.read(4))[0]
-        s = f.read(i * 6)
-        v = unpack('<' + 'BBl' * (len(s) // 6), s)
-        self.child_nodes = chunk(v, 3)
+        self.child_nodes = c.unpack_array(_BBl, c.read_i32())
         return True
 
-    def _read_cobjectgraphnode(self, f):
-        s = f.read(25)
-        if s != b'\x10cObjectGraphNode\x00\x00\x00\x00\x04\x00\x00\x00':
-            error('Error! cObjectGraphNode header:', to_hex(s))
-            error('%#x' % f.tell())
+    def _read_cobjectgraphnode(self, c):
+        if not c.expect_header(b'\x10cObjectGraphNode\x00\x00\x00\x00\x04\x00\x00\x00', 'cObjectGraphNode'):
             return False
-        i = unpack('<l', f.read(4))[0]
-        s = f.read(i * 6)
-        v = unpack('<' + 'BBl' * (len(s) // 6), s)
-        self.extensions = chunk(v, 3)
-        self.obj_string = read_str(f)
+        self.extensions = c.unpack_array(_BBl, c.read_i32())
+        self.obj_string = c.read_str()
         return True
 
-    def _read_crenderablenode(self, f):
-        s = f.read(24)
-        if s != b'\x0fcRenderableNode\x00\x00\x00\x00\x05\x00\x00\x00':
-            error('Error! cRenderableNode header:', to_hex(s))
-            error('%#x' % f.tell())
+    def _read_crenderablenode(self, c):
+        if not c.expect_header(b'\x0fcRenderableNode\x00\x00\x00\x00\x05\x00\x00\x00', 'cRenderableNode'):
             return False
-        if not self._read_cboundednode(f):
+        if not self._read_cboundednode(c):
             return False
-        self.R_number = unpack('<BBl', f.read(6))
-        j = self.R_number[2]
-        v = []
-        while j:
-            v.append(read_str(f))  # such as 'Practical', 'Sims', etc.
-            j -= 1
-        self.R_strings = v
-        self.R_unknown = f.read(5)
+        self.R_number = c.unpack(_BBl)
+        # such as 'Practical', 'Sims', etc.
+        self.R_strings = [c.read_str() for j in xrange(self.R_number[2])]
+        self.R_unknown = c.read(5)
         return True
 
-    def _read_cboundednode(self, f):
-        s = f.read(21)
-        if s != b'\x0ccBoundedNode\x00\x00\x00\x00\x05\x00\x00\x00':
-            error('Error! cBoundedNode header:', to_hex(s))
-            error('%#x' % f.tell())
+    def _read_cboundednode(self, c):
+        if not c.expect_header(b'\x0ccBoundedNode\x00\x00\x00\x00\x05\x00\x00\x00', 'cBoundedNode'):
             return False
-        return self._read_ctransformnode(f)
+        return self._read_ctransformnode(c)
 
-    def _read_ctransformnode(self, f):
-        s = f.read(23)
-        if s != b'\x0ecTransformNode\x62\x64\x24\x65\x07\x00\x00\x00':
-            error('Error! cTransformNode header:', to_hex(s))
-            error('%#x' % f.tell())
+    def _read_ctransformnode(self, c):
+        if not c.expect_header(b'\x0ecTransformNode\x62\x64\x24\x65\x07\x00\x00\x00', 'cTransformNode'):
             return False
-        if not self._read_ccompositiontreenode(f):
+        if not self._read_ccompositiontreenode(c):
             return False
-        self.T_loc = unpack('<3f', f.read(12))
-        self.T_rot = unpack('<4f', f.read(16))
-        i = unpack('<l', f.read(4))[0]
-        self.T_bone_index = i if i != 0x7fffffff else None
+        v = c.unpack(_TRANSFORM)
+        self.T_loc = v[:3]
+        self.T_rot = v[3:7]
+        self.T_bone_index = v[7] if v[7] != 0x7fffffff else None
         return True
 
-    def _read_cextension_h(self, f):
-        s = f.read(19)
-        if s != b'\x0acExtension\x00\x00\x00\x00\x03\x00\x00\x00':
-            error('Error! cExtension header:', to_hex(s))
-            error('%#x' % f.tell())
-            return False
-        return True
+    def _read_cextension_h(self, c):
+        return c.expect_header(b'\x0acExtension\x00\x00\x00\x00\x03\x00\x00\x00', 'cExtension')
+
+    # _skip_-methods move the cursor past the data without decoding it;
+    # headers are not checked (see ResourceFile.load_index)
+
+    @staticmethod
+    def _skip_header(c):
+        # class name, id and version
+        c.skip(c.read_u8() + 8)
+
+    @staticmethod
+    def _skip_str(c):
+        c.skip(c.read_u8())
+
+    @staticmethod
+    def _skip_csgresource(c):
+        _SGNode._skip_header(c)
+        _SGNode._skip_str(c)
+
+    @staticmethod
+    def _skip_ccompositiontreenode(c):
+        _SGNode._skip_header(c)
+        _SGNode._skip_cobjectgraphnode(c)
+        c.skip(c.read_i32() * _BBl.size)
+
+    @staticmethod
+    def _skip_cobjectgraphnode(c):
+        _SGNode._skip_header(c)
+        c.skip(c.read_i32() * _BBl.size)
+        _SGNode._skip_str(c)
+
+    @staticmethod
+    def _skip_crenderablenode(c):
+        _SGNode._skip_header(c)
+        _SGNode._skip_cboundednode(c)
+        for j in xrange(c.unpack(_BBl)[2]):
+            _SGNode._skip_str(c)
+        c.skip(5)
+
+    @staticmethod
+    def _skip_cboundednode(c):
+        _SGNode._skip_header(c)
+        _SGNode._skip_ctransformnode(c)
+
+    @staticmethod
+    def _skip_ctransformnode(c):
+        _SGNode._skip_header(c)
+        _SGNode._skip_ccompositiontreenode(c)
+        c.skip(_TRANSFORM.size)
 
     # write methods
 
@@ -0,0 +1,164 @@
+# -------------------------------------------------------------------------------
+# Copyright (C) 2016  DjAlex88 (https://github.com/djalex88/)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# -------------------------------------------------------------------------------
+
+
+__all__ = ['Package', 'link_key']
+
+import os
+from struct import unpack_from
+from mmap import mmap, ACCESS_READ
+
+import numpy as np
+
+from ._common import *
+from ._refpack import refpack_decompress
+
+
+# DBPF package (.package)
+#
+# header (96 bytes):
+#   'DBPF', version (major, minor), ..., at 32: index version (major),
+#   number of index entries, index offset, index size, hole index (3 x uint32),
+#   index version (minor), ...
+# index entry: type, group, instance, [resource (index version 7.2)], offset, size
+#
+# Resources listed in the directory resource (type 0xE86B1EEF) are compressed:
+#   compressed size (uint32), 0x10FB, uncompressed size (uint24, big-endian), data
+#
+# Resources are identified by (type, group, instance, resource) keys;
+# links of scenegraph resources (ResourceFile.linked_resources) are stored
+# as (group, instance, resource, type) - see link_key().
+
+DIR_TYPE = 0xE86B1EEF
+
+
+def link_key(link):
+    # package key of a linked resource
+    group, instance, resource, type = link
+    return (type, group, instance, resource)
+
+
+class Package(object):
+
+    def __init__(self, filename=None, log_level=1):
+        self._clear()
+        if filename != None: self.load(filename, log_level)
+
+    def _clear(self):
+        self.filename = None
+        self.index = dict()  # key -> (offset, size)
+        self.compressed = dict()  # key -> uncompressed size
+        self._buf = None
+
+    def __str__(self):
+        s = 'Package\n'
+        if self.filename: s += '--Filename: "%s"\n' % self.filename
+        s += '--Number of resources: %i' % len(self.index)
+        return s
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return tuple(key) in self.index
+
+    def keys(self):
+        return list(self.index.keys())
+
+    # ---------------------------------------
+
+    def load(self, filename, log_level=1):
+
+        # the package is mapped read-only; resources are read on request
+
+        self._clear()
+
+        with open(filename, 'rb') as f:
+            buf = mmap(f.fileno(), 0, access=ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+
+        if len(buf) < 96 or buf[:4] != b'DBPF':
+            error('Error! Not a DBPF package:', to_hex(buf[:4]))
+            return False
+
+        major, minor = unpack_from('<2L', buf, 4)
+        count, offset, size = unpack_from('<3L', buf, 36)
+        index_minor = unpack_from('<L', buf, 60)[0]
+
+        if log_level > 0:
+            log('DBPF version: %i.%i, index version: 7.%i' % (major, minor, index_minor))
+            log('Number of resources:', count)
+
+        # 5 or 6 fields
+        n = 6 if index_minor == 2 else 5
+        if count * n * 4 > size or offset + count * n * 4 > len(buf):
+            error('Error! Wrong index (%i entries, offset: %#x, size: %i).' % (count, offset, size))
+            return False
+
+        a = np.frombuffer(buf, '<u4', count * n, offset).reshape(count, n).tolist()
+        if n == 5:
+            self.index = dict(((t[0], t[1], t[2], 0), (t[3], t[4])) for t in a)
+        else:
+            self.index = dict((tuple(t[:4]), (t[4], t[5])) for t in a)
+
+        self._buf = buf
+        self.filename = filename
+
+        # compressed resources
+        for key in self.keys():
+            if key[0] == DIR_TYPE:
+                i, j = self.index.pop(key)
+                a = np.frombuffer(buf, '<u4', j // (n * 4 - 4) * (n - 1), i).reshape(-1, n - 1).tolist()
+                for t in a:
+                    self.compressed[(t[0], t[1], t[2], 0) if n == 5 else tuple(t[:4])] = t[-1]
+
+        if log_level > 0 and self.compressed:
+            log('Compressed resources:', len(self.compressed))
+
+        return True
+
+    def close(self):
+        # the mapping is released once no loaded resource refers to it
+        self._clear()
+
+    def get(self, key):
+
+        # resource data - memoryview of the package, or bytearray,
+        # if compressed (False - damaged); None if there is no such resource
+
+        key = tuple(key)
+        try:
+            offset, size = self.index[key]
+        except KeyError:
+            return None
+
+        data = memoryview(self._buf)[offset:offset + size]
+
+        if key in self.compressed:
+            data = refpack_decompress(data)
+            if data is False or len(data) != self.compressed[key]:
+                error('Error! Could not decompress resource %08X-%08X-%08X-%08X.' % key)
+                return False
+
+        return data
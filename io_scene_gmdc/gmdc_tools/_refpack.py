@@ -0,0 +1,241 @@
+# -------------------------------------------------------------------------------
+# Copyright (C) 2016  DjAlex88 (https://github.com/djalex88/)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# -------------------------------------------------------------------------------
+
+
+__all__ = ['refpack_decompress', 'refpack_compress', 'is_refpack', 'refpack_benchmark']
+
+import time
+
+import numpy as np
+
+from ._common import *
+
+
+# RefPack (QFS) compression
+#
+# [compressed size (uint32) - as stored in packages]
+# flags (0x10, +0x01 - compressed size follows, +0x80 - 4-byte sizes), 0xFB,
+# [compressed size], uncompressed size (big-endian, 3 or 4 bytes),
+# commands:
+#   0ooccapp oooooooo                   - p literals, copy c+3 bytes from offset o+1 (o < 1024)
+#   10cccccc ppoooooo oooooooo          - c+4 bytes, o < 16384
+#   110occpp oooooooo oooooooo cccccccc - c+5 bytes, o < 131072
+#   111ppppp                            - (p+1)*4 literals (4...112)
+#   111111pp                            - p literals, end of data
+
+_MAX_CHAIN = 16  # candidates tried per position by the compressor
+
+
+def _header(data):
+    # offset of the flags byte (0 or 4) or -1
+    for i in (4, 0):
+        if len(data) >= i + 5 and data[i + 1] == 0xFB and data[i] & 0x7E == 0x10:
+            return i
+    return -1
+
+
+def is_refpack(data):
+    return _header(bytearray(data[:10])) >= 0
+
+
+def refpack_decompress(data):
+    # returns bytearray (or False - not compressed / damaged data)
+
+    src = bytearray(data)
+
+    h = _header(src)
+    if h < 0:
+        error('Error! RefPack: wrong header:', to_hex(bytes(src[:6])))
+        return False
+
+    k = 4 if src[h] & 0x80 else 3
+    i = h + 2 + (k if src[h] & 0x01 else 0)
+    size = 0
+    for b in src[i:i + k]:
+        size = size << 8 | b
+    i += k
+
+    out = bytearray(size)
+    p = 0
+
+    try:
+        while True:
+            b0 = src[i]
+            if b0 < 0x80:
+                b1 = src[i + 1]
+                i += 2
+                plain = b0 & 0x03
+                n = ((b0 & 0x1C) >> 2) + 3
+                offset = ((b0 & 0x60) << 3) + b1 + 1
+            elif b0 < 0xC0:
+                b1, b2 = src[i + 1], src[i + 2]
+                i += 3
+                plain = b1 >> 6
+                n = (b0 & 0x3F) + 4
+                offset = ((b1 & 0x3F) << 8) + b2 + 1
+            elif b0 < 0xE0:
+                b1, b2, b3 = src[i + 1], src[i + 2], src[i + 3]
+                i += 4
+                plain = b0 & 0x03
+                n = ((b0 & 0x0C) << 6) + b3 + 5
+                offset = ((b0 & 0x10) << 12) + (b1 << 8) + b2 + 1
+            else:
+                i += 1
+                plain = ((b0 & 0x1F) << 2) + 4 if b0 < 0xFC else b0 & 0x03
+                n = 0
+
+            if plain:
+                out[p:p + plain] = src[i:i + plain]
+                i += plain
+                p += plain
+
+            if n:
+                j = p - offset
+                if j < 0: break
+                if offset >= n:
+                    out[p:p + n] = out[j:j + n]
+                else:
+                    # overlapping - the last offset bytes repeated
+                    out[p:p + n] = (out[j:p] * (n // offset + 1))[:n]
+                p += n
+
+            if b0 >= 0xFC: break
+    except IndexError:
+        pass
+
+    if p != size or len(out) != size:
+        error('Error! RefPack: damaged data (%#x).' % i)
+        return False
+
+    return out
+
+
+def refpack_compress(data, prefix=True):
+    # returns bytes; prefix - with the compressed size in front (as in packages)
+
+    data = bytes(data)
+    size = len(data)
+
+    out = bytearray()
+    table = {}  # 3 bytes -> [positions]
+
+    def literals(i, j):
+        # all but the last (j - i) % 4 literals
+        while j - i > 3:
+            k = min(112, (j - i) & ~3)
+            out.append(0xE0 + (k >> 2) - 1)
+            out.extend(data[i:i + k])
+            i += k
+        return i
+
+    lit = 0  # start of pending literals
+    i = 0
+    while i + 3 <= size:
+
+        key = data[i:i + 3]
+        positions = table.setdefault(key, [])
+
+        best, best_offset = 0, 0
+        m = min(1028, size - i)
+        for j in reversed(positions[-_MAX_CHAIN:]):
+            offset = i - j
+            if offset > 131072: break
+            if best and (best >= m or data[j + best] != data[i + best]): continue
+            n = 3
+            while n + 32 <= m and data[j + n:j + n + 32] == data[i + n:i + n + 32]:
+                n += 32
+            while n < m and data[j + n] == data[i + n]:
+                n += 1
+            if n > best and (offset <= 1024 or (n >= 4 and offset <= 16384) or n >= 5):
+                best, best_offset = n, offset
+                if n == m: break
+
+        positions.append(i)
+
+        if not best:
+            i += 1
+            continue
+
+        lit = literals(lit, i)
+        plain = i - lit
+        n, o = best, best_offset - 1
+        if n <= 10 and o < 1024:
+            out.append(((o >> 3) & 0x60) | ((n - 3) << 2) | plain)
+            out.append(o & 0xFF)
+        elif n <= 67 and o < 16384:
+            out.append(0x80 | (n - 4))
+            out.append((plain << 6) | (o >> 8))
+            out.append(o & 0xFF)
+        else:
+            out.append(0xC0 | ((o >> 12) & 0x10) | (((n - 5) >> 6) & 0x0C) | plain)
+            out.append((o >> 8) & 0xFF)
+            out.append(o & 0xFF)
+            out.append((n - 5) & 0xFF)
+        out.extend(data[lit:i])
+
+        for j in xrange(i + 1, min(i + n, size - 2)):
+            table.setdefault(data[j:j + 3], []).append(j)
+        i += n
+        lit = i
+
+    lit = literals(lit, size)
+    out.append(0xFC + size - lit)
+    out.extend(data[lit:])
+
+    if size >> 24:
+        out[0:0] = bytearray([0x90, 0xFB] + [(size >> k) & 0xFF for k in (24, 16, 8, 0)])
+    else:
+        out[0:0] = bytearray([0x10, 0xFB] + [(size >> k) & 0xFF for k in (16, 8, 0)])
+    if prefix:
+        n = len(out) + 4
+        out[0:0] = bytearray([n & 0xFF, (n >> 8) & 0xFF, (n >> 16) & 0xFF, (n >> 24) & 0xFF])
+
+    return bytes(out)
+
+
+def refpack_benchmark(data=None, repeat=3):
+    # logs and returns throughput (MB/s of uncompressed data) of the codec;
+    # data - sample (default: 1 MB of float32 vertex-like data)
+
+    if data is None:
+        a = np.round(np.random.RandomState(0).normal(0, 1, (1 << 18,)).astype(np.float32), 2)
+        data = a.tobytes()
+
+    size = len(data) / float(1 << 20)
+
+    t = time.time()
+    for i in xrange(repeat):
+        packed = refpack_compress(data)
+    t_compress = (time.time() - t) / repeat
+
+    t = time.time()
+    for i in xrange(repeat):
+        unpacked = refpack_decompress(packed)
+    t_decompress = (time.time() - t) / repeat
+
+    assert unpacked == bytearray(data)
+
+    result = dict(size=len(data), compressed_size=len(packed),
+                  compress=size / max(t_compress, 1e-9), decompress=size / max(t_decompress, 1e-9))
+    log('RefPack: %(size)i -> %(compressed_size)i bytes, compression: %(compress).1f MB/s, '
+        'decompression: %(decompress).1f MB/s' % result)
+    return result
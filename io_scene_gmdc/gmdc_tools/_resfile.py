@@ -21,13 +21,28 @@
 # -------------------------------------------------------------------------------
 
 
-__all__ = ['load_resource']
-
-from struct import pack, unpack
+__all__ = ['load_resource', 'load_resources', 'load_resource_index', 'set_resource_cache', 'clear_resource_cache',
+           'resource_cache_info', 'set_geometry_cache', 'clear_geometry_cache',
+           'footprint_grid', 'footprint_data']
+
+import os
+import json
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+import multiprocessing
+from io import BytesIO
+from struct import pack, unpack, unpack_from, Struct
+from mmap import mmap, ACCESS_READ
+
+import numpy as np
 
 from ._common import *
-from ._node import _SGNode
-from ._gmdc import GeometryDataContainer
+from ._node import _SGNode, _BBl
+from ._gmdc import GeometryDataContainer, GeometryData, DataGroup, IndexGroup, MappedArray
+from ._package import Package
+from ._refpack import refpack_decompress, is_refpack
 
 
 ########################################
@@ -41,16 +56,21 @@ class ResourceNode(_SGNode):
         self.type = 'cResourceNode'
         self.version = 0x07
 
-    def read(self, f, log_level):
-        s = f.read(18)
-        if s != b'\x0dcResourceNode\x33\xc9\x19\xe5':
-            error('Error! cResourceNode header:', to_hex(s))
-            error('%#x' % f.tell())
-            return False
-        if not self._read_check_version(f, 0x07): return False
-        self.Res_unknown1 = f.read(1)
-        if not self._read_csgresource(f) or not self._read_ccompositiontreenode(f): return False
-        self.Res_unknown2 = f.read(5)
+    def read(self, c, log_level):
+        if not c.expect_header(b'\x0dcResourceNode\x33\xc9\x19\xe5', 'cResourceNode'): return False
+        if not self._read_check_version(c, 0x07): return False
+        self.Res_unknown1 = c.read(1)
+        if not self._read_csgresource(c) or not self._read_ccompositiontreenode(c): return False
+        self.Res_unknown2 = c.read(5)
+        return True
+
+    @staticmethod
+    def skip(c):
+        _SGNode._skip_header(c)
+        c.skip(1)
+        _SGNode._skip_csgresource(c)
+        _SGNode._skip_ccompositiontreenode(c)
+        c.skip(5)
         return True
 
     def write(self, f):
@@ -76,34 +96,35 @@ class ShapeRefNode(_SGNode):
         self.type = 'cShapeRefNode'
         self.version = 0x14
 
-    def read(self, f, log_level):
-        s = f.read(18)
-        if s != b'\x0dcShapeRefNode\x17\x55\x24\x65':
-            error('Error! cShapeRefNode header:', to_hex(s))
-            error('%#x' % f.tell())
-            return False
-        if not self._read_check_version(f, (0x14, 0x15)) or not self._read_crenderablenode(f): return False
+    def read(self, c, log_level):
+        if not c.expect_header(b'\x0dcShapeRefNode\x17\x55\x24\x65', 'cShapeRefNode'): return False
+        if not self._read_check_version(c, (0x14, 0x15)) or not self._read_crenderablenode(c): return False
         # linked resource indices (?)
-        i = unpack('<l', f.read(4))[0]
-        s = f.read(i * 6)
-        v = unpack('<' + 'BBl' * (len(s) // 6), s)
-        self.SR_data1 = chunk(v, 3)
+        self.SR_data1 = c.unpack_array(_BBl, c.read_i32())
         # 4 bytes
-        self.SR_unknown1 = f.read(4)
+        self.SR_unknown1 = c.read(4)
         # morphs (?)
-        i = unpack('<l', f.read(4))[0]
-        s = f.read(4 * i)
-        self.SR_data2 = chunk(s, 4)
+        i = c.read_i32()
+        self.SR_data2 = chunk(c.read(4 * i), 4)
         if self.version >= 0x15:
-            v = []
-            while i:
-                v.append(read_str(f))
-                i -= 1
-            self.SR_strings = v
+            self.SR_strings = [c.read_str() for j in xrange(i)]
         # unknown
-        i = unpack('<l', f.read(4))[0]
-        self.SR_unknown2 = f.read(i)
-        self.SR_unknown3 = f.read(4)
+        self.SR_unknown2 = c.read(c.read_i32())
+        self.SR_unknown3 = c.read(4)
+        return True
+
+    @staticmethod
+    def skip(c):
+        c.skip(c.read_u8() + 4)
+        version = c.read_i32()
+        _SGNode._skip_crenderablenode(c)
+        c.skip(c.read_i32() * _BBl.size + 4)
+        i = c.read_i32()
+        c.skip(4 * i)
+        if version >= 0x15:
+            for j in xrange(i):
+                _SGNode._skip_str(c)
+        c.skip(c.read_i32() + 4)
         return True
 
     def write(self, f):
@@ -146,8 +167,13 @@ class TransformNode(_SGNode):
         self.type = 'cTransformNode'
         self.version = 0x07
 
-    def read(self, f, log_level):
-        return self._read_ctransformnode(f)
+    def read(self, c, log_level):
+        return self._read_ctransformnode(c)
+
+    @staticmethod
+    def skip(c):
+        _SGNode._skip_ctransformnode(c)
+        return True
 
     def write(self, f):
         self._write_ctransformnode(f)
@@ -163,45 +189,79 @@ class DataListExtension(_SGNode):
         self.type = 'cDataListExtension'
         self.version = 0x01
 
-    def read(self, f, log_level):
-        s = f.read(23)
-        if s != b'\x12cDataListExtension\x56\x6d\x83\x6a':
-            error('Error! cDataListExtension header:', to_hex(s))
-            error('%#x' % f.tell())
-            return False
+    def read(self, c, log_level):
+        if not c.expect_header(b'\x12cDataListExtension\x56\x6d\x83\x6a', 'cDataListExtension'): return False
         v = []
-        if not self._read_check_version(f, 0x01) or not self._read_cextension_h(f) or not self._read_ext_data(f,
+        if not self._read_check_version(c, 0x01) or not self._read_cextension_h(c) or not self._read_ext_data(c,
                                                                                                               v): return False
         assert len(v) == 1
         self.Ext_data = v[0]
         return True
 
     @staticmethod
-    def _read_ext_data(f, data):
-        i = unpack('B', f.read(1))[0]  # type
-        s = read_str(f)  # name
-        if i == 0x06:  # string (?)
-            data.append((0x06, s, read_str(f)))
-        elif i == 0x02:  # int (?)
-            data.append((0x02, s, unpack('<l', f.read(4))[0]))
-        elif i == 0x03:  # float (?)
-            data.append((0x03, s, unpack('<f', f.read(4))[0]))
-        elif i == 0x05:  # 3 floats (?)
-            data.append((0x05, s, unpack('<3f', f.read(12))))
-        elif i == 0x08:  # 4 floats (?)
-            data.append((0x08, s, unpack('<4f', f.read(16))))
-        elif i == 0x09:  # N bytes (?)
-            i = unpack('<l', f.read(4))[0]
-            data.append((0x09, s, f.read(i)))
-        elif i == 0x07:  # list of data
-            v = []
-            for i in xrange(unpack('<l', f.read(4))[0]):
-                if not DataListExtension._read_ext_data(f, v): return False
-            data.append((0x07, s, v))
-        else:
-            error('Error! cDataListExtension. Unknown data type: %02X', i)
-            error('%#x' % f.tell())
-            return False
+    def _read_ext_data(c, data):
+        # reads one item into data; nested lists are read
+        # through a stack of (parent list, number of items left)
+        stack = []
+        k = 1
+        while True:
+            while not k:
+                if not stack: return True
+                data, k = stack.pop()
+            k -= 1
+            i = c.read_u8()  # type
+            s = c.read_str()  # name
+            if i == 0x06:  # string (?)
+                data.append((0x06, s, c.read_str()))
+            elif i == 0x02:  # int (?)
+                data.append((0x02, s, c.read_i32()))
+            elif i == 0x03:  # float (?)
+                data.append((0x03, s, c.read_f32()))
+            elif i == 0x05:  # 3 floats (?)
+                data.append((0x05, s, c.unpack('<3f')))
+            elif i == 0x08:  # 4 floats (?)
+                data.append((0x08, s, c.unpack('<4f')))
+            elif i == 0x09:  # N bytes (?)
+                data.append((0x09, s, c.read(c.read_i32())))
+            elif i == 0x07:  # list of data
+                v = []
+                data.append((0x07, s, v))
+                stack.append((data, k))
+                data, k = v, c.read_i32()
+            else:
+                error('Error! cDataListExtension. Unknown data type: %02X' % i)
+                error('%#x' % c.tell())
+                return False
+
+    @staticmethod
+    def skip(c):
+        _SGNode._skip_header(c)
+        _SGNode._skip_header(c)  # cExtension
+        # items left in each nested list
+        stack = [1]
+        while stack:
+            if not stack[-1]:
+                stack.pop()
+                continue
+            stack[-1] -= 1
+            i = c.read_u8()  # type
+            _SGNode._skip_str(c)  # name
+            if i == 0x06:
+                _SGNode._skip_str(c)
+            elif i in (0x02, 0x03):
+                c.skip(4)
+            elif i == 0x05:
+                c.skip(12)
+            elif i == 0x08:
+                c.skip(16)
+            elif i == 0x09:
+                c.skip(c.read_i32())
+            elif i == 0x07:
+                stack.append(c.read_i32())
+            else:
+                error('Error! cDataListExtension. Unknown data type: %02X' % i)
+                error('%#x' % c.tell())
+                return False
         return True
 
     def write(self, f):
@@ -212,27 +272,32 @@ class DataListExtension(_SGNode):
 
     @staticmethod
     def _write_ext_data(f, data):
-        i, s, v = data
-        f.write(pack('B', i))
-        write_str(f, s)
-        if i == 0x06:
-            write_str(f, v)
-        elif i == 0x02:
-            f.write(pack('<l', v))
-        elif i == 0x03:
-            f.write(pack('<f', v))
-        elif i == 0x05:
-            f.write(pack('<3f', *v))
-        elif i == 0x08:
-            f.write(pack('<4f', *v))
-        elif i == 0x09:
-            f.write(pack('<l', len(v)) + v)
-        elif i == 0x07:
-            f.write(pack('<l', len(v)))
-            for x in v:
-                DataListExtension._write_ext_data(f, x)
-        else:
-            raise AssertionError
+        # nested lists are written through a stack of item iterators
+        stack = [iter((data,))]
+        while stack:
+            for i, s, v in stack[-1]:
+                f.write(pack('B', i))
+                write_str(f, s)
+                if i == 0x06:
+                    write_str(f, v)
+                elif i == 0x02:
+                    f.write(pack('<l', v))
+                elif i == 0x03:
+                    f.write(pack('<f', v))
+                elif i == 0x05:
+                    f.write(pack('<3f', *v))
+                elif i == 0x08:
+                    f.write(pack('<4f', *v))
+                elif i == 0x09:
+                    f.write(pack('<l', len(v)) + v)
+                elif i == 0x07:
+                    f.write(pack('<l', len(v)))
+                    stack.append(iter(v))
+                    break
+                else:
+                    raise AssertionError
+            else:
+                stack.pop()
 
     def __str__(self):
         s = 'cDataListExtension'
@@ -273,16 +338,19 @@ class BoneDataExtension(_SGNode):
         self.type = 'cBoneDataExtension'
         self.version = 0x04
 
-    def read(self, f, log_level):
-        s = f.read(23)
-        if s != b'\x12cBoneDataExtension\xc5\x5b\x07\xe9':
-            error('Error! cBoneDataExtension header:', to_hex(s))
-            error('%#x' % f.tell())
-            return False
-        if not self._read_check_version(f, (0x04, 0x05)) or not self._read_cextension_h(f): return False
-        self.B_ext_unknown = f.read(12)
-        self.B_ext_float = unpack('<f', f.read(4))[0]
-        self.B_ext_quat = unpack('<4f', f.read(16))
+    def read(self, c, log_level):
+        if not c.expect_header(b'\x12cBoneDataExtension\xc5\x5b\x07\xe9', 'cBoneDataExtension'): return False
+        if not self._read_check_version(c, (0x04, 0x05)) or not self._read_cextension_h(c): return False
+        self.B_ext_unknown = c.read(12)
+        self.B_ext_float = c.read_f32()
+        self.B_ext_quat = c.unpack('<4f')
+        return True
+
+    @staticmethod
+    def skip(c):
+        _SGNode._skip_header(c)
+        _SGNode._skip_header(c)  # cExtension
+        c.skip(32)
         return True
 
     def write(self, f):
@@ -308,15 +376,18 @@ class LightRefNode(_SGNode):
         self.type = 'cLightRefNode'
         self.version = 0x0a
 
-    def read(self, f, log_level):
-        s = f.read(18)
-        if s != b'\x0dcLightRefNode\x18\x20\x3d\x25':
-            error('Error! cLightRefNode header:', to_hex(s))
-            error('%#x' % f.tell())
-            return False
-        if not self._read_check_version(f, 0x0a) or not self._read_crenderablenode(f): return False
-        self.L_index = unpack('<BBl', f.read(6))
-        self.L_unknown = f.read(2)
+    def read(self, c, log_level):
+        if not c.expect_header(b'\x0dcLightRefNode\x18\x20\x3d\x25', 'cLightRefNode'): return False
+        if not self._read_check_version(c, 0x0a) or not self._read_crenderablenode(c): return False
+        self.L_index = c.unpack(_BBl)
+        self.L_unknown = c.read(2)
+        return True
+
+    @staticmethod
+    def skip(c):
+        _SGNode._skip_header(c)
+        _SGNode._skip_crenderablenode(c)
+        c.skip(_BBl.size + 2)
         return True
 
     def write(self, f):
@@ -341,13 +412,10 @@ class ViewerRefNode(_SGNode):
         self.type = 'cViewerRefNode'
         self.version = 0x0d
 
-    def _read_cViewerRefNodeBase(self, f):
-        s = f.read(27)
-        if s != b'\x12cViewerRefNodeBase\x00\x00\x00\x00\x05\x00\x00\x00':
-            error('Error! cViewerRefNodeBase header:', to_hex(s))
-            error('%#x' % f.tell())
+    def _read_cViewerRefNodeBase(self, c):
+        if not c.expect_header(b'\x12cViewerRefNodeBase\x00\x00\x00\x00\x05\x00\x00\x00', 'cViewerRefNodeBase'):
             return False
-        return self._read_crenderablenode(f)
+        return self._read_crenderablenode(c)
 
     def _write_cViewerRefNodeBase(self, f):
         f.write(b'\x12cViewerRefNodeBase\x00\x00\x00\x00\x05\x00\x00\x00')
@@ -356,14 +424,23 @@ class ViewerRefNode(_SGNode):
     def _str_cViewerRefNodeBase(self):
         return self._str_crenderablenode()
 
-    def read(self, f, log_level):
-        s = f.read(19)
-        if s != b'\x0ecViewerRefNode\xbb\x6d\xa7\xdc':
-            error('Error! cViewerRefNode header:', to_hex(s))
-            error('%#x' % f.tell())
-            return False
-        if not self._read_check_version(f, (0x0d, 0x0e)) or not self._read_cViewerRefNodeBase(f): return False
-        self.V_data = f.read(0x9c if self.version == 0x0E else 0x9b)
+    @staticmethod
+    def _skip_cViewerRefNodeBase(c):
+        _SGNode._skip_header(c)
+        _SGNode._skip_crenderablenode(c)
+
+    def read(self, c, log_level):
+        if not c.expect_header(b'\x0ecViewerRefNode\xbb\x6d\xa7\xdc', 'cViewerRefNode'): return False
+        if not self._read_check_version(c, (0x0d, 0x0e)) or not self._read_cViewerRefNodeBase(c): return False
+        self.V_data = c.read(0x9c if self.version == 0x0E else 0x9b)
+        return True
+
+    @staticmethod
+    def skip(c):
+        c.skip(c.read_u8() + 4)
+        version = c.read_i32()
+        ViewerRefNode._skip_cViewerRefNodeBase(c)
+        c.skip(0x9c if version == 0x0E else 0x9b)
         return True
 
     def write(self, f):
@@ -387,16 +464,21 @@ class ViewerRefNodeRecursive(ViewerRefNode):
         self.type = 'cViewerRefNodeRecursive'
         self.version = 0x01
 
-    def read(self, f, log_level):
-        s = f.read(28)
-        if s != b'\x17cViewerRefNodeRecursive\x8e\x2b\x15\x0c':
-            error('Error! cViewerRefNodeRecursive header:', to_hex(s))
-            error('%#x' % f.tell())
-            return False
-        if not self._read_check_version(f, 0x01) or not self._read_cViewerRefNodeBase(f): return False
-        self.VR_unknown = f.read(1)
-        self.VR_string = read_str(f)
-        self.VR_data = f.read(0x40)
+    def read(self, c, log_level):
+        if not c.expect_header(b'\x17cViewerRefNodeRecursive\x8e\x2b\x15\x0c', 'cViewerRefNodeRecursive'): return False
+        if not self._read_check_version(c, 0x01) or not self._read_cViewerRefNodeBase(c): return False
+        self.VR_unknown = c.read(1)
+        self.VR_string = c.read_str()
+        self.VR_data = c.read(0x40)
+        return True
+
+    @staticmethod
+    def skip(c):
+        _SGNode._skip_header(c)
+        ViewerRefNode._skip_cViewerRefNodeBase(c)
+        c.skip(1)
+        _SGNode._skip_str(c)
+        c.skip(0x40)
         return True
 
     def write(self, f):
@@ -424,15 +506,19 @@ class GeometryNode(_SGNode):
         self.type = 'cGeometryNode'
         self.version = 0x0c
 
-    def read(self, f, log_level):
-        s = f.read(18)
-        if s != b'\x0dcGeometryNode\x8c\x83\xa3\x7b':
-            error('Error! cGeometryNode header:', to_hex(s))
-            error('%#x' % f.tell())
-            return False
-        if not self._read_check_version(f, 0x0c) or not self._read_cobjectgraphnode(f) or not self._read_csgresource(
-            f): return False
-        self.G_unknown = f.read(7)
+    def read(self, c, log_level):
+        if not c.expect_header(b'\x0dcGeometryNode\x8c\x83\xa3\x7b', 'cGeometryNode'): return False
+        if not self._read_check_version(c, 0x0c) or not self._read_cobjectgraphnode(c) or not self._read_csgresource(
+            c): return False
+        self.G_unknown = c.read(7)
+        return True
+
+    @staticmethod
+    def skip(c):
+        _SGNode._skip_header(c)
+        _SGNode._skip_cobjectgraphnode(c)
+        _SGNode._skip_csgresource(c)
+        c.skip(7)
         return True
 
     def write(self, f):
@@ -456,27 +542,25 @@ class MaterialDefinition(_SGNode):
         self.type = 'cMaterialDefinition'
         self.version = 0x0b
 
-    def read(self, f, log_level):
-        s = f.read(24)
-        if s != b'\x13cMaterialDefinition\x78\x69\x59\x49':
-            error('Error! cGeometryNode header:', to_hex(s))
-            error('%#x' % f.tell())
-            return False
-        if not self._read_check_version(f, 0x0b) or not self._read_csgresource(f): return False
-        self.Mat_name = read_str(f)
-        self.Mat_type = read_str(f)
-        i = unpack('<l', f.read(4))[0]
-        v = []
-        while i:
-            v.append((read_str(f), read_str(f)))
-            i -= 1
-        self.Mat_properties = v
-        i = unpack('<l', f.read(4))[0]
-        v = []
-        while i:
-            v.append(read_str(f))
-            i -= 1
-        self.Mat_references = v
+    def read(self, c, log_level):
+        if not c.expect_header(b'\x13cMaterialDefinition\x78\x69\x59\x49', 'cMaterialDefinition'): return False
+        if not self._read_check_version(c, 0x0b) or not self._read_csgresource(c): return False
+        self.Mat_name = c.read_str()
+        self.Mat_type = c.read_str()
+        self.Mat_properties = [(c.read_str(), c.read_str()) for i in xrange(c.read_i32())]
+        self.Mat_references = [c.read_str() for i in xrange(c.read_i32())]
+        return True
+
+    @staticmethod
+    def skip(c):
+        _SGNode._skip_header(c)
+        _SGNode._skip_csgresource(c)
+        _SGNode._skip_str(c)  # name
+        _SGNode._skip_str(c)  # type
+        for i in xrange(c.read_i32() * 2):
+            _SGNode._skip_str(c)
+        for i in xrange(c.read_i32()):
+            _SGNode._skip_str(c)
         return True
 
     def write(self, f):
@@ -508,17 +592,83 @@ class MaterialDefinition(_SGNode):
 
 # -------------------------------------------------------------------------------
 
+# node type ids
+_NODE_TYPE_IDS = {
+    'cResourceNode': b'\x33\xc9\x19\xe5',
+    'cTransformNode': b'\x62\x64\x24\x65',
+    'cShapeRefNode': b'\x17\x55\x24\x65',
+    'cDataListExtension': b'\x56\x6d\x83\x6a',
+    'cBoneDataExtension': b'\xc5\x5b\x07\xe9',
+    'cLightRefNode': b'\x18\x20\x3d\x25',
+    'cViewerRefNode': b'\xbb\x6d\xa7\xdc',
+    'cViewerRefNodeRecursive': b'\x8e\x2b\x15\x0c',
+    'cGeometryNode': b'\x8c\x83\xa3\x7b',
+    'cGeometryDataContainer': b'\x87\x86\x4F\xAC',
+    'cMaterialDefinition': b'\x78\x69\x59\x49',
+}
+
+_NODE_CLASSES = {
+    b'\x33\xc9\x19\xe5': ResourceNode,
+    b'\x62\x64\x24\x65': TransformNode,
+    b'\x17\x55\x24\x65': ShapeRefNode,
+    b'\x56\x6d\x83\x6a': DataListExtension,
+    b'\xc5\x5b\x07\xe9': BoneDataExtension,
+    b'\x18\x20\x3d\x25': LightRefNode,
+    b'\xbb\x6d\xa7\xdc': ViewerRefNode,
+    b'\x8e\x2b\x15\x0c': ViewerRefNodeRecursive,
+    b'\x8c\x83\xa3\x7b': GeometryNode,
+    b'\x87\x86\x4F\xAC': GeometryDataContainer,
+    b'\x78\x69\x59\x49': MaterialDefinition,
+}
+
+_NODE_TYPE_NAMES = dict((v, k) for k, v in _NODE_TYPE_IDS.items())
+
+
+class _NodeProxy(object):
+    # stands in for node #index of a lazily loaded ResourceFile;
+    # index and type are known, the node is decoded on first access
+    # to any other attribute (see ResourceFile.get_node)
+
+    __slots__ = ('index', 'type', '_res')
+
+    def __init__(self, res, index, type):
+        self._res = res
+        self.index = index
+        self.type = type
+
+    def __getattr__(self, name):
+        if name[:2] == '__' or name in _NodeProxy.__slots__:
+            raise AttributeError(name)
+        return getattr(self._res.get_node(self.index), name)
+
+    def __setattr__(self, name, value):
+        if name in _NodeProxy.__slots__:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._res.get_node(self.index), name, value)
+
+    def __str__(self):
+        return str(self._res.get_node(self.index))
+
+    def __repr__(self):
+        return self.__str__()
+
+
 class ResourceFile(object):
 
-    def __init__(self, filename=None, log_level=1):
+    def __init__(self, filename=None, log_level=1, use_mmap=False, expand_mappings=True, lazy=False):
         self._clear()
-        if filename != None: self.load(filename, log_level)
+        if filename != None: self.load(filename, log_level, use_mmap, expand_mappings, lazy)
 
     def _clear(self):
         self.filename = None
         self.linked_resources = list()
         self.nodes = list()
+        self.toc = list()  # [(offset, node type id)]
         self.sg_resource_name = None
+        self._buf = None  # loaded file; unmodified nodes are written from it
+        self._node_cache = dict()  # nodes decoded by get_node() (lazy loading)
+        self._expand_mappings = True
 
     def __str__(self):
         s = 'ResourceFile\n'
@@ -533,37 +683,146 @@ class ResourceFile(object):
     def __repr__(self):
         return self.__str__()
 
+    def clone(self):
+        # independent copy; arrays that are views into the file buffer
+        # (read-only) are shared, everything else is copied
+        buf = self._buf if self._buf is not None else bytearray()
+        f = BytesIO()
+        _BufferPickler(f, buf).dump(self)
+        return _BufferUnpickler(BytesIO(f.getvalue()), buf).load()
+
     # ---------------------------------------
 
-    def load(self, filename, log_level=1):
+    def load(self, filename, log_level=1, use_mmap=False, expand_mappings=True, lazy=False):
 
-        with open(filename, 'rb') as f:
-            s = f.read(4)
-            if s != b'\x01\x00\xff\xff':
-                error('Error! Wrong file header:', to_hex(s))
-                return False
+        # the file is read at once (or, if use_mmap is set, through
+        # a read-only memory mapping); geometry sections are array views
+        # into this buffer, which is kept as long as any of them is referenced.
+        # filename may also be a buffer (bytes, bytearray, memoryview, mmap),
+        # used as is, or a file object, read from its current position.
+        # if expand_mappings is False, sections with an index mapping
+        # are returned as MappedArray (mapping + shared base array).
+        # if lazy is set, nodes are decoded on first access (see load_index)
+
+        if lazy:
+            return self.load_index(filename, log_level, use_mmap, False, expand_mappings)
+
+        buf, filename = _read_source(filename, use_mmap)
+        return self._load(Cursor(buf), filename, log_level, expand_mappings)
+
+    def _load(self, c, filename, log_level, expand_mappings):
+
+        self._expand_mappings = expand_mappings
+
+        if not self._load_header(c, log_level) or not self._load_resource(c, log_level):
+            self._clear()
+            return False
+
+        self.filename = filename
+
+        try:
+            self.sg_resource_name = self.nodes[0].sg_resource_name
+        except:
+            pass
 
-            if not self._load_resource(f, log_level):
+        return True
+
+    def load_index(self, filename, log_level=1, use_mmap=False, cache=False, expand_mappings=True):
+
+        # reads the linked resources and the table of contents (offset and
+        # type of each node) only; nodes holds proxies, and each node is decoded
+        # on first access to its properties (or by get_node()) and then kept.
+        # offsets are found by a pass over node headers and counts (nodes are
+        # not decoded), or, if cache is set, taken from the index file next to
+        # the file (filename + '.toc'), which is written after the pass and
+        # ignored once the file changes (paths only)
+
+        buf, filename = _read_source(filename, use_mmap)
+        return self._load_index(Cursor(buf), filename, log_level, cache and filename is not None, expand_mappings)
+
+    def _load_index(self, c, filename, log_level, cache, expand_mappings):
+
+        self._expand_mappings = expand_mappings
+
+        if not self._load_header(c, log_level):
+            self._clear()
+            return False
+
+        toc_filename = cache and filename + '.toc'
+        offsets = cache and _read_toc_file(toc_filename, _stat(filename), len(self.toc))
+
+        if offsets:
+            log_level > 0 and log('Index file:', toc_filename)
+        else:
+            offsets = self._skip_nodes(c, log_level)
+            if offsets is False:
                 self._clear()
                 return False
+            cache and _write_toc_file(toc_filename, _stat(filename), offsets)
 
+        self.toc = [(offset, nt_id) for offset, (_, nt_id) in zip(offsets, self.toc)]
+        self.nodes = [_NodeProxy(self, i, _NODE_TYPE_NAMES[nt_id]) for i, (_, nt_id) in enumerate(self.toc)]
+        self._buf = c.buf
         self.filename = filename
 
         try:
-            self.sg_resource_name = self.nodes[0].sg_resource_name
+            self.sg_resource_name = self.get_node(0).sg_resource_name
         except:
             pass
 
         return True
 
-    def _load_resource(self, f, log_level):
+    def _skip_nodes(self, c, log_level):
+
+        # offsets of the nodes, found by walking node headers and counts;
+        # nodes are not decoded (nor checked - errors show up on access)
+
+        offsets = []
+        for i, (_, nt_id) in enumerate(self.toc):
+            offset = c.tell()
+            try:
+                _class = _NODE_CLASSES[nt_id]
+            except KeyError:
+                error('Error! Unknown node.')
+                error('%#x' % offset)
+                return False
+            if not _class.skip(c): return False
+            offsets.append(offset)
+            log_level > 0 and log('>Node #%s (offset: %08x) - ' % (str(i).rjust(4, '_'), offset) +
+                                  _NODE_TYPE_NAMES[nt_id])
+
+        if c.tell() > c.size:
+            error('Error! Unexpected end of file.')
+            return False
+
+        return offsets
+
+    def get_node(self, i):
+
+        # node #i (decoded, if the file is loaded lazily)
+
+        node = self.nodes[i]
+        if not isinstance(node, _NodeProxy): return node
+
+        try:
+            return self._node_cache[i]
+        except KeyError:
+            offset, nt_id = self.toc[i]
+            node = self._read_node(Cursor(self._buf, offset), i, nt_id, 0)
+            if node: self._node_cache[i] = node
+            return node
+
+    def _load_header(self, c, log_level):
+
+        s = c.read(4)
+        if s != b'\x01\x00\xff\xff':
+            error('Error! Wrong file header:', to_hex(s))
+            return False
 
         # linked resources
         #
-        k = unpack('<l', f.read(4))[0]
-        s = chunk(f.read(k * 16), 16)
-        self.linked_resources = map(lambda x: unpack('<4L', x), s)
-        assert len(self.linked_resources) == k
+        k = c.read_i32()
+        self.linked_resources = c.unpack_array('<4L', k)
 
         if log_level > 0:
             log('Linked resources (%i):' % k)
@@ -572,126 +831,737 @@ class ResourceFile(object):
 
         # types of nodes
         #
-        k = unpack('<l', f.read(4))[0]
-        s = f.read(k * 4)
-        node_types = chunk(s, 4)
+        k = c.read_i32()
+        node_types = chunk(c.read(k * 4), 4)
         assert len(node_types) == k
+        self.toc = [(None, nt_id) for nt_id in node_types]
 
         if log_level > 0: log('Number of nodes:', k)
 
-        dd = {
-            b'\x33\xc9\x19\xe5': ResourceNode,
-            b'\x62\x64\x24\x65': TransformNode,
-            b'\x17\x55\x24\x65': ShapeRefNode,
-            b'\x56\x6d\x83\x6a': DataListExtension,
-            b'\xc5\x5b\x07\xe9': BoneDataExtension,
-            b'\x18\x20\x3d\x25': LightRefNode,
-            b'\xbb\x6d\xa7\xdc': ViewerRefNode,
-            b'\x8e\x2b\x15\x0c': ViewerRefNodeRecursive,
-            b'\x8c\x83\xa3\x7b': GeometryNode,
-            b'\x87\x86\x4F\xAC': GeometryDataContainer,
-            b'\x78\x69\x59\x49': MaterialDefinition,
-        }
+        return True
 
-        # nodes
-        #
-        Nodes = []
-        for i, nt_id in enumerate(node_types):
+    def _read_node(self, c, i, nt_id, log_level):
 
-            offset = f.tell()
+        offset = c.tell()
 
-            try:
-                _class = dd[nt_id]
-            except KeyError:
-                error('Error! Unknown node.')
-                error('%#x' % f.tell())
-                return False
+        try:
+            _class = _NODE_CLASSES[nt_id]
+        except KeyError:
+            error('Error! Unknown node.')
+            error('%#x' % offset)
+            return False
 
-            node = _class(i)
-            if not node.read(f, log_level): return False
+        node = _class(i)
+        if not node.read(c, log_level): return False
+        if node._keep_raw:
+            node._set_span((offset, c.tell()))
 
-            Nodes.append(node)
+        if node.type == 'cGeometryDataContainer' and not self._expand_mappings:
+            for group in node.geometry.data_groups:
+                group.expand_mappings = False
+
+        if log_level > 0:
+            log('>Node #%s (offset: %08x) - ' % (str(i).rjust(4, '_'), offset) + (
+                str(node) if log_level > 1 else node.type))
+
+        return node
 
-            if log_level > 0:
-                log('>Node #%s (offset: %08x) - ' % (str(i).rjust(4, '_'), offset) + (
-                    str(node) if log_level > 1 else node.type))
+    def _load_resource(self, c, log_level):
+
+        # nodes
+        #
+        Nodes = []
+        toc = []
+        for i, (_, nt_id) in enumerate(self.toc):
+            toc.append((c.tell(), nt_id))
+            node = self._read_node(c, i, nt_id, log_level)
+            if not node: return False
+            Nodes.append(node)
 
         self.nodes = Nodes
+        self.toc = toc
+        self._buf = c.buf
 
         return True
 
     # ---------------------------------------
 
     def save(self):
-
-        with open(self.filename, 'wb') as f:
-            self._write_resource_file(f)
+        self.save_as(self.filename)
 
     def save_as(self, filename):
-
-        with open(filename, 'wb') as f:
-            self._write_resource_file(f)
+        f = BytesIO()
+        spans = self._write_resource_file(f)
+        if isinstance(self._buf, mmap) and self.filename and os.path.exists(filename) and \
+                os.path.samefile(filename, self.filename):
+            # the file is mapped - write a new file and replace it instead of
+            # overwriting its contents; the mapping must be closed first on
+            # Windows, so the nodes are rebased onto the data just written.
+            # Arrays still viewing the mapping (geometry loaded with use_mmap)
+            # keep it open, in that case the file cannot be replaced there
+            s = filename + '.tmp'
+            with open(s, 'wb') as f2:
+                f2.write(f.getvalue())
+            m = self._buf
+            self._rebase(f.getvalue(), spans)
+            try:
+                m.close()
+            except BufferError:
+                pass
+            getattr(os, 'replace', os.rename)(s, filename)
+        else:
+            with open(filename, 'wb') as f2:
+                f2.write(f.getvalue())
+
+    def _rebase(self, buf, spans):
+        # makes buf (the file written, with node #i at spans[i]) the loaded file
+        self.toc = [(span[0], nt_id) for span, (_, nt_id) in zip(spans, self.toc)]
+        for k, node in enumerate(self.nodes):
+            node = self._node_cache.get(k) if isinstance(node, _NodeProxy) else node
+            if node is not None and node._keep_raw:
+                node._set_span(spans[k])
+        self._buf = buf
 
     def _write_resource_file(self, f):
 
+        nodes = self.nodes
+
         f.write(b'\x01\x00\xff\xff')
 
         f.write(pack('<l', len(self.linked_resources)))
         for t in self.linked_resources: f.write(pack('<4L', *t))
 
-        dd = {
-            'cResourceNode': b'\x33\xc9\x19\xe5',
-            'cTransformNode': b'\x62\x64\x24\x65',
-            'cShapeRefNode': b'\x17\x55\x24\x65',
-            'cDataListExtension': b'\x56\x6d\x83\x6a',
-            'cBoneDataExtension': b'\xc5\x5b\x07\xe9',
-            'cLightRefNode': b'\x18\x20\x3d\x25',
-            'cViewerRefNode': b'\xbb\x6d\xa7\xdc',
-            'cViewerRefNodeRecursive': b'\x8e\x2b\x15\x0c',
-            'cGeometryNode': b'\x8c\x83\xa3\x7b',
-            'cGeometryDataContainer': b'\x87\x86\x4F\xAC',
-            'cMaterialDefinition': b'\x78\x69\x59\x49',
-        }
-
-        f.write(pack('<l', len(self.nodes)))
-        for node in self.nodes:
-            f.write(dd[node.type])
-        for node in self.nodes:
-            node.write(f)
+        f.write(pack('<l', len(nodes)))
+        for node in nodes:
+            f.write(_NODE_TYPE_IDS[node.type])
+        spans = list()
+        for k, node in enumerate(nodes):
+            start = f.tell()
+            span = self._raw_span(k) if isinstance(node, _NodeProxy) else node._get_span()
+            if span:
+                # unmodified - copy as loaded
+                i, j = span
+                f.write(self._buf[i:j])
+            else:
+                node.write(f)
+            spans.append((start, f.tell()))
+        return spans
+
+    def _raw_span(self, i):
+        # (start, end) of node #i, loaded lazily, if it is not decoded
+        # or unmodified; the end of the last node is only known once decoded
+        if i not in self._node_cache and i + 1 < len(self.toc):
+            return (self.toc[i][0], self.toc[i + 1][0])
+        return self.get_node(i)._get_span()
 
 
 # <- /ResourceFile
 
 
-def load_resource(filename, log_level=1):
+def _read_file(filename, use_mmap):
+    with open(filename, 'rb') as f:
+        if use_mmap and os.fstat(f.fileno()).st_size:
+            return _decompress(mmap(f.fileno(), 0, access=ACCESS_READ))
+        return _decompress(f.read())
+
+
+def _decompress(buf):
+    # compressed files (RefPack) are decompressed
+    if buf[:4] != b'\x01\x00\xff\xff' and is_refpack(buf):
+        return refpack_decompress(buf) or buf
+    return buf
+
+
+def _is_path(source):
+    return not (_is_buffer(source) or hasattr(source, 'read'))
+
+
+def _is_buffer(source):
+    # (str is bytes - file name, in Python 2)
+    return isinstance(source, (bytearray, memoryview, mmap)) or (isinstance(source, bytes) and bytes is not str)
+
+
+def _read_source(source, use_mmap):
+    # returns buffer, filename (None, if not known)
+    if _is_buffer(source):
+        return _decompress(source), None
+    if hasattr(source, 'read'):
+        name = getattr(source, 'name', None)
+        return _decompress(source.read()), name if isinstance(name, str) else None
+    return _read_file(source, use_mmap), source
+
+
+def load_resource(filename, log_level=1, use_mmap=False, expand_mappings=True, lazy=False, key=None):
+    # filename - path, buffer or file object (see ResourceFile.load);
+    # key - (type, group, instance, resource) of the resource in package
+    # filename (path or Package); the resource is read from the mapped package
+    if key is not None:
+        return _load_packed_resource(filename, key, log_level, expand_mappings, lazy)
+    if _cache.max_size and _is_path(filename):
+        return _cache.load(filename, log_level, use_mmap, expand_mappings, lazy)
+    return _load_resource(filename, log_level, use_mmap, expand_mappings, lazy)
+
+
+def _load_resource(filename, log_level, use_mmap, expand_mappings, lazy):
+    if _geometry_cache.directory and not lazy:
+        return _geometry_cache.load(filename, log_level, use_mmap, expand_mappings)
     res = ResourceFile()
-    return res if res.load(filename, log_level) else False
+    return res if res.load(filename, log_level, use_mmap, expand_mappings, lazy) else False
+
+
+def _load_packed_resource(package, key, log_level, expand_mappings, lazy):
+    if not isinstance(package, Package):
+        package = Package(package, log_level)
+        if not package.filename: return False
+
+    buf = package.get(key)
+    if not buf:
+        buf is None and error('Error! Resource %08X-%08X-%08X-%08X not found in "%s".' % (
+            tuple(key) + (package.filename,)))
+        return False
+
+    res = ResourceFile()
+    c = Cursor(buf)
+    if lazy:
+        return res if res._load_index(c, None, log_level, False, expand_mappings) else False
+    return res if res._load(c, None, log_level, expand_mappings) else False
+
+
+def _resource_name(buf):
+    # sg_resource_name of the first node (None - not a scenegraph resource or no name)
+    if buf[:4] != b'\x01\x00\xff\xff': return None
+    res = ResourceFile()
+    c = Cursor(buf)
+    try:
+        if not res._load_header(c, 0) or not res.toc or res.toc[0][1] not in _NODE_CLASSES: return None
+        node = res._read_node(c, 0, res.toc[0][1], 0)
+        return getattr(node, 'sg_resource_name', None) if node else None
+    except Exception:
+        return None
+
+
+def load_resource_index(filename, log_level=1, use_mmap=False, cache=False, expand_mappings=True):
+    # lazily loaded ResourceFile (see ResourceFile.load_index)
+    res = ResourceFile()
+    return res if res.load_index(filename, log_level, use_mmap, cache, expand_mappings) else False
+
+
+_TOC_HEADER = b'GMDC-TOC\x01\x00\x00\x00'
+
+
+def _read_toc_file(toc_filename, st, count):
+    # node offsets, if the index file exists and matches the file (st - _stat())
+    try:
+        with open(toc_filename, 'rb') as f:
+            data = f.read()
+    except (IOError, OSError):
+        return None
+    k = len(_TOC_HEADER) + 20
+    if data[:len(_TOC_HEADER)] != _TOC_HEADER or len(data) < k:
+        return None
+    size, mtime, n = unpack('<qdl', data[len(_TOC_HEADER):k])
+    if (size, mtime) != st or n != count or len(data) != k + 4 * n:
+        return None
+    return list(unpack('<%iL' % n, data[k:]))
+
+
+def _write_toc_file(toc_filename, st, offsets):
+    try:
+        with open(toc_filename, 'wb') as f:
+            f.write(_TOC_HEADER + pack('<qdl', st[0], st[1], len(offsets)))
+            f.write(pack('<%iL' % len(offsets), *offsets))
+    except (IOError, OSError):
+        # not cached (e.g. read-only directory)
+        pass
+
+
+# -------------------------------------------------------------------------------
+#  Batch loading
+#
+# Files are parsed in worker processes. Each worker maps its file and
+# pickles the parsed ResourceFile with array views into the mapping
+# replaced by (offset, dtype, shape) references; the parent maps the same
+# file and binds these references to it, so array payloads are shared
+# through the page cache instead of being copied between processes.
+#
+
+def _buffer_address(buf):
+    return np.frombuffer(buf, np.uint8).__array_interface__['data'][0] if len(buf) else 0
+
+
+class _BufferPickler(pickle.Pickler):
+    def __init__(self, f, buf):
+        pickle.Pickler.__init__(self, f, pickle.HIGHEST_PROTOCOL)
+        self.buf = buf
+        self.address = _buffer_address(buf)
+        self.size = len(buf)
+
+    def persistent_id(self, obj):
+        if obj is self.buf:
+            return ('buf',)
+        if type(obj) is np.ndarray and obj.base is not None and obj.flags.c_contiguous and obj.nbytes:
+            i = obj.__array_interface__['data'][0] - self.address
+            if 0 <= i and i + obj.nbytes <= self.size:
+                return ('array', i, obj.dtype.str, obj.shape)
+        return None
+
+
+class _BufferUnpickler(pickle.Unpickler):
+    # arrays - buffer of array references (default: buf)
+    def __init__(self, f, buf, arrays=None):
+        pickle.Unpickler.__init__(self, f)
+        self.buf = buf
+        self.arrays = buf if arrays is None else arrays
+
+    def persistent_load(self, pid):
+        if pid[0] == 'buf':
+            return self.buf
+        i, dtype, shape = pid[1:]
+        a = np.frombuffer(self.arrays, dtype, int(np.prod(shape)), i)
+        return a.reshape(shape)
+
+
+def _stat(filename):
+    st = os.stat(filename)
+    return (st.st_size, st.st_mtime)
+
+
+def _load_worker(args):
+    filename, log_level, expand_mappings = args
+    try:
+        st = _stat(filename)
+        buf = _read_file(filename, True)
+        res = ResourceFile()
+        if not res._load(Cursor(buf), filename, log_level, expand_mappings):
+            return None
+        f = BytesIO()
+        _BufferPickler(f, buf).dump(res)
+        return st, f.getvalue()
+    except:
+        print_last_exception()
+        return None
+
+
+def load_resources(filenames, log_level=0, workers=None, expand_mappings=True):
+    # loads several files in parallel (workers - number of processes,
+    # all CPUs by default); returns a list with a ResourceFile (or False)
+    # for each file, in order. Arrays of the results are views into
+    # read-only memory mappings of the files (as with use_mmap=True).
+
+    filenames = list(filenames)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, len(filenames))
+
+    if workers < 2:
+        return [load_resource(filename, log_level, True, expand_mappings) for filename in filenames]
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(_load_worker, [(filename, log_level, expand_mappings) for filename in filenames], 1)
+    finally:
+        pool.close()
+        pool.join()
+
+    resources = []
+    for filename, result in zip(filenames, results):
+        res = False
+        if result:
+            st, data = result
+            try:
+                if _stat(filename) == st:
+                    res = _BufferUnpickler(BytesIO(data), _read_file(filename, True)).load()
+                else:
+                    # modified in the meantime
+                    res = load_resource(filename, log_level, True, expand_mappings)
+            except:
+                print_last_exception()
+        resources.append(res)
+    return resources
+
+
+# -------------------------------------------------------------------------------
+#  Cache
+#
+# Loaded files are kept pickled as in batch loading (array views into the
+# file buffer are stored as references), and every hit is unpickled anew,
+# so callers get their own nodes and cannot modify the cached ones.
+# Entries are valid while the file size and modification time are unchanged.
+#
+
+class _ResourceCache(object):
+    # entries are changed under the lock (files may be loaded by
+    # several threads, see ResourceIndex.resolve); loading is not locked
+
+    def __init__(self):
+        self.max_size = 0  # bytes; 0 - disabled
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.entries = OrderedDict()  # key -> (stat, pickled data, buffer, size); least recently used first
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def load(self, filename, log_level, use_mmap, expand_mappings, lazy):
+        key = (os.path.realpath(filename), use_mmap, expand_mappings, lazy)
+        st = _stat(filename)
+
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry:
+                self.size -= entry[3]
+                if entry[0] == st:
+                    self._add(key, entry)
+                else:
+                    entry = None
+            if entry:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if entry:
+            log_level > 0 and log('Loaded from cache:', filename)
+            res = _BufferUnpickler(BytesIO(entry[1]), entry[2]).load()
+            res.filename = filename
+            return res
+
+        res = _load_resource(filename, log_level, use_mmap, expand_mappings, lazy)
+        if not res:
+            return False
+
+        f = BytesIO()
+        _BufferPickler(f, res._buf).dump(res)
+        data = f.getvalue()
+        # mapped files are accounted for by the system
+        size = len(data) + (0 if isinstance(res._buf, mmap) else len(res._buf))
+        if size <= self.max_size:
+            with self._lock:
+                old = self.entries.pop(key, None)
+                if old: self.size -= old[3]
+                self._add(key, (st, data, res._buf, size))
+
+        return res
+
+    def _add(self, key, entry):
+        self.entries[key] = entry
+        self.size += entry[3]
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            while self.size > self.max_size:
+                self.size -= self.entries.popitem(last=False)[1][3]
+
+
+_cache = _ResourceCache()
+
+
+def set_resource_cache(max_size):
+    # enables caching of files loaded by load_resource(); least recently used
+    # files are dropped when the estimated size of cached files exceeds
+    # max_size (bytes). 0 - disables the cache
+    _cache.max_size = max_size
+    _cache.evict()
+
+
+def clear_resource_cache():
+    _cache.clear()
+
+
+def resource_cache_info():
+    # dict with hits, misses, entries, size and max_size
+    with _cache._lock:
+        return dict(hits=_cache.hits, misses=_cache.misses, entries=len(_cache.entries), size=_cache.size,
+                    max_size=_cache.max_size)
 
 
 # -------------------------------------------------------------------------------
+#  Geometry cache
+#
+# GMDC files (a single geometry data container) are stored decoded in a
+# cache directory, one entry per file content (SHA-1 of the file) and
+# mapping option:
+#
+#   header: 'GMDC-GEO', version (uint32), 4 bytes (0), offset and size of the metadata (2 x uint64)
+#   arrays: payloads of all arrays, 16-byte aligned
+#   metadata: JSON - version and resource name of the node, attributes of
+#     the geometry, its data groups and index groups; arrays are given as
+#     {"array": [offset, dtype, shape]}, tuples as {"tuple": [...]} and
+#     mapped sections as {"mapped": [base, indices]}
+#
+# Entries are mapped read-only, so arrays are loaded from the page cache
+# instead of being decoded. The file itself is still read (to be hashed);
+# the header is taken from it. Entries of another version are ignored and
+# replaced; least recently used entries are removed once the cache
+# directory exceeds its size limit.
+#
+
+_GEOMETRY_CACHE_HEADER = b'GMDC-GEO'
+_GEOMETRY_CACHE_VERSION = 2
+_GEOMETRY_CACHE_ENTRY = Struct('<8sLLQQ')
+
+
+def _is_gmdc(buf):
+    # True if buf holds a geometry data container only
+    try:
+        if bytes(buf[:4]) != b'\x01\x00\xff\xff': return False
+        i = 8 + unpack_from('<l', buf, 4)[0] * 16
+        return unpack_from('<l', buf, i)[0] == 1 and \
+            bytes(buf[i + 4:i + 8]) == _NODE_TYPE_IDS['cGeometryDataContainer']
+    except Exception:
+        return False
+
+
+def _dump_value(v, f, arrays):
+    # JSON value of v; arrays are written to f (at 16-byte aligned positions)
+    if isinstance(v, np.ndarray):
+        try:
+            return arrays[id(v)][1]
+        except KeyError:
+            pass
+        assert not v.dtype.hasobject
+        f.write(b'\x00' * (-f.tell() % 16))
+        ref = {'array': [f.tell(), v.dtype.str, list(v.shape)]}
+        f.write(np.ascontiguousarray(v).tobytes())
+        arrays[id(v)] = (v, ref)
+        return ref
+    if isinstance(v, MappedArray):
+        return {'mapped': [_dump_value(v.base, f, arrays), _dump_value(v.indices, f, arrays)]}
+    if isinstance(v, tuple):
+        return {'tuple': [_dump_value(x, f, arrays) for x in v]}
+    if isinstance(v, list):
+        return [_dump_value(x, f, arrays) for x in v]
+    return v  # (json.dumps fails on other types)
+
+
+def _load_value(v, entry):
+    # inverse of _dump_value; arrays are views into entry
+    if isinstance(v, list):
+        return [_load_value(x, entry) for x in v]
+    if isinstance(v, dict):
+        if 'array' in v:
+            i, dtype, shape = v['array']
+            dtype = np.dtype(str(dtype))
+            assert not dtype.hasobject
+            return np.frombuffer(entry, dtype, int(np.prod(shape)), i).reshape(shape)
+        if 'mapped' in v:
+            return MappedArray(*[_load_value(x, entry) for x in v['mapped']])
+        return tuple(_load_value(x, entry) for x in v['tuple'])
+    return v
+
+
+def _dump_attrs(obj, f, arrays):
+    return dict((k, _dump_value(v, f, arrays)) for k, v in obj.__dict__.items() if k[0] != '_')
+
+
+def _load_attrs(obj, attrs, entry):
+    # only attributes the object has are set
+    for k, v in attrs.items():
+        if k in obj.__dict__ and k[0] != '_':
+            setattr(obj, k, _load_value(v, entry))
+    return obj
+
+
+class _GeometryCache(object):
+    # entries are written and evicted under the lock (see _ResourceCache)
+
+    def __init__(self):
+        self.directory = None
+        self.max_size = 0
+        self._lock = threading.RLock()
+
+    def load(self, filename, log_level, use_mmap, expand_mappings):
+        buf, filename = _read_source(filename, use_mmap)
+        res = ResourceFile()
+        if not _is_gmdc(buf):
+            # not cached (nor hashed)
+            return res if res._load(Cursor(buf), filename, log_level, expand_mappings) else False
+
+        path = os.path.join(self.directory,
+                            hashlib.sha1(buf).hexdigest() + ('.geo' if expand_mappings else '-m.geo'))
+
+        cached = self._read_entry(path, buf, expand_mappings)
+        if cached:
+            log_level > 0 and log('Loaded from geometry cache:', path)
+            cached.filename = filename
+            return cached
+
+        if not res._load(Cursor(buf), filename, log_level, expand_mappings):
+            return False
+        with self._lock:
+            self._write_entry(path, res.nodes[0])
+            self.evict()
+        return res
+
+    def _read_entry(self, path, buf, expand_mappings):
+        try:
+            with open(path, 'rb') as f:
+                entry = mmap(f.fileno(), 0, access=ACCESS_READ)
+            magic, version, _, i, n = _GEOMETRY_CACHE_ENTRY.unpack_from(entry)
+            if magic != _GEOMETRY_CACHE_HEADER or version != _GEOMETRY_CACHE_VERSION:
+                return None
+            meta = json.loads(bytes(entry[i:i + n]).decode('utf-8'))
+
+            node = GeometryDataContainer(0)
+            node.version = meta['version']
+            node.sg_resource_name = meta['sg_resource_name']
+            g = meta['geometry']
+            node.geometry = _load_attrs(GeometryData(
+                [_load_attrs(DataGroup(), attrs, entry) for attrs in g.pop('data_groups')],
+                [_load_attrs(IndexGroup(None), attrs, entry) for attrs in g.pop('index_groups')]), g, entry)
+
+            res = ResourceFile()
+            c = Cursor(buf)
+            res._load_header(c, 0)
+            res.toc = [(c.tell(), res.toc[0][1])]
+            res.nodes = [node]
+            res._buf = buf
+            res._expand_mappings = expand_mappings
+            res.sg_resource_name = node.sg_resource_name
+
+            os.utime(path, None)  # recently used
+            return res
+        except:
+            # missing, outdated or damaged
+            return None
+
+    def _write_entry(self, path, node):
+        f = BytesIO()
+        f.write(b'\x00' * _GEOMETRY_CACHE_ENTRY.size)
+        arrays = {}
+        g = node.geometry
+        for group in g.data_groups:
+            group._decode()
+        meta = _dump_attrs(g, f, arrays)
+        meta['data_groups'] = [_dump_attrs(group, f, arrays) for group in g.data_groups]
+        meta['index_groups'] = [_dump_attrs(group, f, arrays) for group in g.index_groups]
+        meta = dict(version=node.version, sg_resource_name=node.sg_resource_name, geometry=meta)
+        try:
+            data = json.dumps(meta).encode('utf-8')
+        except (TypeError, ValueError):
+            # not cached (e.g. values set by other code)
+            return
+        i = f.tell()
+        f.write(data)
+        f.seek(0)
+        f.write(_GEOMETRY_CACHE_ENTRY.pack(_GEOMETRY_CACHE_HEADER, _GEOMETRY_CACHE_VERSION, 0, i, len(data)))
+
+        s = '%s.%i.tmp' % (path, os.getpid())
+        try:
+            with open(s, 'wb') as f2:
+                f2.write(f.getvalue())
+            getattr(os, 'replace', os.rename)(s, path)
+        except (IOError, OSError):
+            # not cached (e.g. no space left)
+            os.path.exists(s) and os.remove(s)
+
+    def _entries(self):
+        # [(last used, size, path)]
+        v = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.geo'):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                    v.append((st.st_mtime, st.st_size, path))
+                except OSError:
+                    pass
+        return v
+
+    def evict(self):
+        with self._lock:
+            v = sorted(self._entries())
+            size = sum(t[1] for t in v)
+            for mtime, n, path in v:
+                if size <= self.max_size: break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                size -= n
+
+
+_geometry_cache = _GeometryCache()
+
+
+def set_geometry_cache(directory, max_size=1 << 30):
+    # enables the geometry cache in directory (created if needed)
+    # for load_resource(); the directory is kept within max_size bytes.
+    # None - disables the cache
+    if directory:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        _geometry_cache.directory = directory
+        _geometry_cache.max_size = max_size
+        _geometry_cache.evict()
+    else:
+        _geometry_cache.directory = None
+
+
+def clear_geometry_cache():
+    # removes all entries from the cache directory
+    if _geometry_cache.directory:
+        for t in _geometry_cache._entries():
+            os.remove(t[2])
+
+
+# -------------------------------------------------------------------------------
+
+def footprint_grid(data):
+    # decodes a footprint pattern (property list: minx, maxx, miny, maxy
+    # and a 16 x 16 bit tile for each "(x,y)") into a boolean array
+    # grid[row, col] - row = (y - miny) * 16 + j, col = (x - minx) * 16 + i;
+    # returns minx, miny, grid
+
+    w = dict((s, v) for i, s, v in data)
+
+    minx, maxx, miny, maxy = w['minx'], w['maxx'], w['miny'], w['maxy']
+    nx, ny = maxx - minx + 1, maxy - miny + 1
+
+    tiles = np.zeros((ny, nx, 32), np.uint8)
+    for y in xrange(ny):
+        for x in xrange(nx):
+            v = w.get('(%i,%i)' % (x + minx, y + miny))
+            if v: tiles[y, x] = np.frombuffer(v, np.uint8, 32)
+
+    # bit i of row j (uint16) - point i
+    grid = np.unpackbits(tiles, axis=2, bitorder='little').reshape(ny, nx, 16, 16)
+    return minx, miny, grid.transpose(0, 2, 1, 3).reshape(ny * 16, nx * 16).astype(bool)
+
+
+def footprint_data(minx, miny, grid):
+    # inverse of footprint_grid(); returns the property list of a footprint pattern
+
+    ny, nx = grid.shape[0] // 16, grid.shape[1] // 16
+    tiles = np.packbits(np.asarray(grid, bool).reshape(ny, 16, nx, 16), axis=3, bitorder='little')
+    tiles = tiles.transpose(2, 0, 1, 3).reshape(nx, ny, 32)
+
+    data = [(0x02, 'minx', minx), (0x02, 'maxx', minx + nx - 1), (0x02, 'miny', miny), (0x02, 'maxy', miny + ny - 1)]
+    for x in xrange(nx):
+        for y in xrange(ny):
+            data.append((0x09, '(%i,%i)' % (x + minx, y + miny), tiles[x, y].tobytes()))
+    return data
+
 
 def str_footprint(footprint):
     def str_footprint_pattern(data):
 
-        w = dict((s, v) for i, s, v in data)
+        minx, miny, grid = footprint_grid(data)
+        ny, nx = grid.shape[0] // 16, grid.shape[1] // 16
 
-        minx = w['minx']
-        maxx = w['maxx']
-        miny = w['miny']
-        maxy = w['maxy']
+        # 'X' / '-' for each point and a space after each tile
+        a = np.full((ny * 16, nx, 17), ord(' '), np.uint8)
+        a[:, :, :16] = np.where(grid, ord('X'), ord('-')).reshape(ny * 16, nx, 16)
+        lines = [bytes(row).decode('latin_1') for row in a.reshape(ny * 16, nx * 17)]
 
         s = ''
 
-        for y in xrange(maxy, miny - 1, -1):
-            ss = [str()] * 16
-            for x in xrange(minx, maxx + 1):
-                key = '(%i,%i)' % (x, y)
-                v = w[key]
-                for i, j in zip(xrange(0, 32, 2), xrange(15, -1, -1)):
-                    a = unpack('<H', v[i:i + 2])[0]
-                    ss[j] += "".join(reversed(format(a, '016b').replace('0', '-').replace('1', 'X'))) + '\x20'
-                s += key.ljust(16) + '\x20'
-            s += '\n' + '\n'.join(ss) + ('\n' if y != miny else '')
+        for y in xrange(ny - 1, -1, -1):
+            s += ''.join(('(%i,%i)' % (x + minx, y + miny)).ljust(16) + '\x20' for x in xrange(nx))
+            s += '\n' + '\n'.join(lines[y * 16 + 15:y * 16 - 1 if y else None:-1]) + ('\n' if y else '')
         return s
 
     return '\n'.join('--Footprint pattern "%s":\n' % name + str_footprint_pattern(data) for i, name, data in footprint)
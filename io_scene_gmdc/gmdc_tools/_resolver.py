@@ -0,0 +1,270 @@
+# -------------------------------------------------------------------------------
+# Copyright (C) 2016  DjAlex88 (https://github.com/djalex88/)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# -------------------------------------------------------------------------------
+
+
+__all__ = ['ResourceIndex']
+
+import os
+import re
+import pickle
+import threading
+from struct import unpack_from
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from ._common import *
+from ._package import Package, link_key
+from ._refpack import is_refpack
+from ._resfile import load_resource, _read_file, _resource_name, _stat
+
+
+# Resource index
+#
+# Maps keys (type, group, instance, resource) and resource names
+# (sg_resource_name) to locations:
+#   (path, key) - resource in package
+#   (path, None) - file
+# Files carry no key; theirs is derived from the type of the first node
+# and the resource name (see _name_key).
+# The index is built once by scanning directories and can be written to
+# a file; rebuilding reuses entries of files that have not changed.
+
+_INDEX_VERSION = 2
+
+
+class ResourceIndex(object):
+
+    def __init__(self, filename=None):
+        self._clear()
+        if filename != None: self.read(filename)
+
+    def _clear(self):
+        self.files = dict()  # path -> (size, mtime, [(key, name)], is_package)
+        self.keys = dict()  # key -> location
+        self.keys3 = dict()  # (type, group, instance) -> location, of keys with resource 0
+        self.names = dict()  # lowercase name -> [location]
+        self._packages = dict()  # path -> Package
+        self._lock = threading.Lock()  # guards _packages
+
+    def __str__(self):
+        s = 'ResourceIndex\n'
+        s += '--Files: %i\n' % len(self.files)
+        s += '--Keys: %i\n' % len(self.keys)
+        s += '--Names: %i' % len(self.names)
+        return s
+
+    def __repr__(self):
+        return self.__str__()
+
+    # ---------------------------------------
+
+    def build(self, paths, log_level=1):
+
+        # paths - files and directories (scanned recursively)
+
+        files = dict()
+        for path in paths:
+            if os.path.isdir(path):
+                for root, dirs, filenames in os.walk(path):
+                    for name in sorted(filenames):
+                        self._add_file(files, os.path.join(root, name), log_level)
+            else:
+                self._add_file(files, path, log_level)
+
+        self.files = files
+        self._update()
+
+        if log_level > 0:
+            log('Indexed files: %i, keys: %i, names: %i' % (len(self.files), len(self.keys), len(self.names)))
+
+        return True
+
+    def _add_file(self, files, path, log_level):
+        path = os.path.abspath(path)
+        try:
+            st = _stat(path)
+            entry = self.files.get(path)
+            if entry and entry[:2] == st:
+                files[path] = entry  # unchanged
+                return
+            with open(path, 'rb') as f:
+                head = f.read(10)
+            if head[:4] == b'DBPF':
+                package = Package(path, 0)
+                if not package.filename: return
+                v = []
+                for key in package.keys():
+                    data = package.get(key)
+                    v.append((key, _resource_name(data) if data else None))
+                is_package = True
+            elif head[:4] == b'\x01\x00\xff\xff' or is_refpack(head):
+                buf = _read_file(path, True)
+                name = _resource_name(buf)
+                if name is None: return
+                type = unpack_from('<L', buf, 12 + unpack_from('<l', buf, 4)[0] * 16)[0]  # of the first node
+                v = [(_name_key(type, name), name)]
+                is_package = False
+            else:
+                return
+        except (IOError, OSError):
+            print_last_exception()
+            return
+        log_level > 1 and log('--%s (%i)' % (path, len(v)))
+        files[path] = st + (v, is_package)
+
+    def _update(self):
+        self.keys = dict()
+        self.keys3 = dict()
+        self.names = dict()
+        self._packages = dict()
+        for path in sorted(self.files):
+            size, mtime, v, is_package = self.files[path]
+            for key, name in v:
+                location = (path, key if is_package else None)
+                if key is not None:
+                    self.keys.setdefault(key, location)
+                    if is_package and not key[3]:
+                        self.keys3.setdefault(key[:3], location)
+                if name:
+                    self.names.setdefault(name.lower(), []).append(location)
+
+    # ---------------------------------------
+
+    def read(self, filename):
+        with open(filename, 'rb') as f:
+            data = pickle.load(f)
+        if data.get('version') != _INDEX_VERSION:
+            error('Error! Resource index "%s" has version %s (expected %i).' % (
+                filename, data.get('version'), _INDEX_VERSION))
+            return False
+        self.files = data['files']
+        self._update()
+        return True
+
+    def write(self, filename):
+        with open(filename, 'wb') as f:
+            pickle.dump(dict(version=_INDEX_VERSION, files=self.files), f, pickle.HIGHEST_PROTOCOL)
+
+    # ---------------------------------------
+
+    def locate(self, key):
+        # location of the resource (None - not indexed); resources of
+        # 7.1 packages (indexed with resource 0) match any resource
+        key = tuple(key)
+        return self.keys.get(key) or self.keys3.get(key[:3])
+
+    def find(self, name):
+        # locations of resources named name (case-insensitive)
+        return self.names.get(name.lower(), [])
+
+    def load_resource(self, location, log_level=0):
+        path, key = location
+        if key is None:
+            return load_resource(path, log_level)
+        with self._lock:
+            try:
+                package = self._packages[path]
+            except KeyError:
+                package = self._packages[path] = Package(path, 0)
+        return load_resource(package, log_level, key=key)
+
+    def resolve(self, root, log_level=1, workers=None):
+
+        # loads root (location or ResourceFile) and, breadth-first, all
+        # resources it links to, directly or not; returns OrderedDict
+        # { location -> ResourceFile } in order of loading, with False
+        # for resources that are not indexed or could not be loaded.
+        # workers - number of threads loading each level (default: 1)
+
+        result = OrderedDict()
+        if not isinstance(root, tuple):
+            result[(root.filename, None)] = root
+        level = [root]
+
+        pool = ThreadPool(workers) if workers and workers > 1 else None
+        try:
+            while level:
+                # load
+                locations = [x for x in level if isinstance(x, tuple)]
+                if pool:
+                    loaded = pool.map(self.load_resource, locations)
+                else:
+                    loaded = [self.load_resource(x) for x in locations]
+                for location, res in zip(locations, loaded):
+                    result[location] = res
+                    if log_level > 0:
+                        log('%s %s' % (res and 'Loaded:' or 'Error! Could not load:', _str_location(location)))
+
+                # links of the loaded resources
+                next_level = []
+                for res in [x for x in level if not isinstance(x, tuple)] + loaded:
+                    for link in (res.linked_resources if res else ()):
+                        key = link_key(link)
+                        location = self.locate(key)
+                        if location is None:
+                            location = (None, key)
+                            if location not in result:
+                                log_level > 0 and log('Missing: %08X-%08X-%08X-%08X' % key)
+                                result[location] = False
+                        elif location not in result and location not in next_level:
+                            next_level.append(location)
+                level = next_level
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        return result
+
+
+def _crc(data, width, poly, init, xorout):
+    # non-reflected CRC (MSB first)
+    top = 1 << (width - 1)
+    mask = (1 << width) - 1
+    crc = init
+    for b in bytearray(data):
+        crc ^= b << (width - 8)
+        for i in xrange(8):
+            crc = ((crc << 1) ^ poly if crc & top else crc << 1) & mask
+    return crc ^ xorout
+
+
+_GROUP_PREFIX = re.compile(r'^##0x([0-9a-fA-F]{8})!')
+
+
+def _name_key(type, name):
+    # key of a scenegraph resource named name, derived the way the game
+    # tools do: the group is given by a "##0x<group>!" prefix of the name
+    # (default: 0x1C050000), instance and resource are CRC-24 (OpenPGP,
+    # high byte set) and CRC-32 (BZIP2) of the rest, in lower case
+    m = _GROUP_PREFIX.match(name)
+    group = int(m.group(1), 16) if m else 0x1C050000
+    s = name[m.end():] if m else name
+    s = s.strip().lower().encode('latin_1', 'replace')
+    instance = _crc(s, 24, 0x864CFB, 0xB704CE, 0) | 0xFF000000
+    resource = _crc(s, 32, 0x04C11DB7, 0xFFFFFFFF, 0xFFFFFFFF)
+    return (type, group, instance, resource)
+
+
+def _str_location(location):
+    path, key = location
+    return path if key is None else '%s [%08X-%08X-%08X-%08X]' % ((path,) + key)
@@ -31,6 +31,7 @@ Tooltip: 'Import TS2 GMDC file' """
 from io_scene_gmdc.gmdc_tools import *
 from itertools import chain, count
 
+import numpy as np
 import bpy
 from mathutils import Vector as BlenderVector
 
@@ -126,45 +127,45 @@ def create_objects(geometry, transform_tree, settings):
 
         data_group = geometry.data_groups[group.data_group_index]
 
-        # define index mapping
-        s = {}  # old_index -> new_index
-        for i, x in enumerate(sorted(set(chain(*group.indices)))): s[x] = i
-
-        # map indices
-        i = [(s[i], s[j], s[k]) for i, j, k in group.indices]
+        # define index mapping (used - sorted old indices) and map indices
+        used, i = np.unique(group.indices, return_inverse=True)
+        I = i.reshape(-1, 3)
+        i = list(map(tuple, I.tolist()))
 
         # filtering function
-        __fv = lambda x: [x for i, x in enumerate(x) if i in s]
+        __fv = lambda x: np.asarray(x[used])
 
-        v = __fv(data_group.vertices)
+        v = __fv(data_group.vertices).tolist()
 
         # texture coords
-        if data_group.tex_coords:
-            t = __fv(data_group.tex_coords)
-            t = [(t[i], t[j], t[k]) for i, j, k in i]
+        if len(data_group.tex_coords):
+            t = list(map(tuple, __fv(data_group.tex_coords)[I].tolist()))
         else:
-            t = group.tex_coords and group.tex_coords[:]  # copy
+            t = group.tex_coords is not None and [tuple(map(tuple, x)) for x in np.asarray(group.tex_coords).tolist()]
 
         # also, Blender does not like triangles with zero-index vertex on 3rd position
         # as well as "triangles" with less than 3 different indices:
         #   https://www.blender.org/api/249PythonDoc/Mesh.MFaceSeq-class.html#extend
         #
         w = []
-        for i, t in enumerate(i):
-            if 0 == t[2]:
-                i[i] = (t[2], t[0], t[1])
-                log('--Triangle # %i reordered:' % i, t, '->', i[i])
+        for k, f in enumerate(i):
+            if 0 == f[2]:
+                i[k] = (f[2], f[0], f[1])
+                count_event('triangles reordered')
+                log_enabled(LOG_DEBUG) and debug('--Triangle # %i reordered:' % k, f, '->', i[k])
                 if t:
-                    uv1, uv2, uv3 = t[i]
-                    t[i] = (uv3, uv1, uv2)
-            if len(set(t)) < 3:
-                w.append(i)
-                log('--Triangle # %i' % i, t, 'removed')
-        for i in reversed(w):
-            del i[i]
+                    uv1, uv2, uv3 = t[k]
+                    t[k] = (uv3, uv1, uv2)
+            if len(set(f)) < 3:
+                w.append(k)
+                count_event('triangles removed')
+                log_enabled(LOG_DEBUG) and debug('--Triangle # %i' % k, f, 'removed')
+        for k in reversed(w):
+            del i[k]
             if t:
-                del t[i]
+                del t[k]
         w = None
+        log_counters('--')
 
         log('--Creating mesh object (vertices: %i, triangles: %i)...' % (len(v), len(i)))
 
@@ -179,19 +180,22 @@ def create_objects(geometry, transform_tree, settings):
 
         mesh_objects.append(obj)  # save reference to current object
 
-        log('--Rigging:', data_group.bones and 'yes' or 'no')
+        log('--Rigging:', len(data_group.bones) and 'yes' or 'no')
 
         # rigging
         #
-        if data_group.bones:
+        if len(data_group.bones):
 
             B = __fv(data_group.bones)
-            W = __fv(data_group.weights)
+            C = __fv(data_group.bone_counts).tolist()  # number of influences
+            W = __fv(data_group.weights).tolist()
 
             log('--Assigning vertices to vertex groups...')
 
-            # map bones
-            B = [tuple(group.bones[j] for j in b) for b in B]
+            # map bones (local -> global indices; padding is never used)
+            j = np.zeros(256, np.int32)
+            j[:len(group.bones)] = group.bones
+            B = j[B].tolist()
 
             dd = dict()  # { index -> unique_bone_name }
             for idx in group.bones:
@@ -202,8 +206,8 @@ def create_objects(geometry, transform_tree, settings):
             v_group_names = [dd.get(j) for j in range(max(dd) + 1)]
 
             # assign vertices
-            for i, b, w in zip(count(), B, W):
-                for wi, j in enumerate(b):
+            for i, b, n, w in zip(count(), B, C, W):
+                for wi, j in enumerate(b[:n]):
                     if wi == 3:
                         f = 1.0 - sum(w)
                     else:
@@ -214,12 +218,12 @@ def create_objects(geometry, transform_tree, settings):
 
         # shape keys
         #
-        if data_group.keys:
+        if len(data_group.keys):
 
             log('--Adding shape keys...')
 
-            keys = __fv(data_group.keys)
-            dV = map(__fv, data_group.dVerts)
+            keys = __fv(data_group.keys).tolist()
+            dV = [__fv(x).tolist() if len(x) else [] for x in data_group.dVerts]
 
             log('\x20\x20--Length of dV: (%i, %i, %i, %i)' % tuple(map(len, dV)))
 
@@ -264,8 +268,8 @@ def create_objects(geometry, transform_tree, settings):
             v, i = geometry.static_bmesh
 
             mesh = bpy.types.Mesh.New('b_mesh')
-            mesh.verts.extend(v)
-            mesh.faces.extend(i)
+            mesh.verts.extend(list(map(tuple, np.asarray(v).tolist())))
+            mesh.faces.extend(list(map(tuple, np.asarray(i).tolist())))
 
             obj = scene.objects.new(mesh)
             obj.name = 'b_mesh'
@@ -283,15 +287,15 @@ def create_objects(geometry, transform_tree, settings):
             for idx, part in enumerate(geometry.dynamic_bmesh):
                 if part:
                     v, i = part
-                    s = {}  # { old_index -> new_index }
                     j = len(mesh.verts)
-                    for i, x in enumerate(sorted(set(chain(*i)))): s[x] = i + j
+                    used, i = np.unique(i, return_inverse=True)  # used - sorted old indices
+                    s = range(j, j + len(used))  # new indices
 
                     rot, loc = geometry.inverse_transforms[idx]
                     t = Transform(loc, rot).get_inverse()
 
-                    v = [t.transformPoint(Vector(*x)).to_tuple() for i, x in enumerate(v) if i in s]
-                    i = [(s[i], s[j], s[k]) for i, j, k in i]
+                    v = [t.transformPoint(Vector(*x)).to_tuple() for x in np.asarray(v)[used].tolist()]
+                    i = list(map(tuple, (i.reshape(-1, 3) + j).tolist()))
 
                     mesh.verts.extend(v)
                     mesh.faces.extend(i)
@@ -300,7 +304,7 @@ def create_objects(geometry, transform_tree, settings):
                     name = make_unique_bone_name(name, idx, v_group_names)
                     v_group_names.add(name)
                     mesh.addVertGroup(name)
-                    mesh.assignVertsToGroup(name, s.values(), 1.0, 1)
+                    mesh.assignVertsToGroup(name, list(s), 1.0, 1)
 
             mesh.calcNormals()
 
@@ -386,6 +390,16 @@ def create_objects(geometry, transform_tree, settings):
 
 
 def begin_import():
+    # the log level is set for the import and restored afterwards
+    # (gmdc_tools may be used by other scripts in the session)
+    level = set_log_level(LOG_INFO)
+    try:
+        _begin_import()
+    finally:
+        set_log_level(level)
+
+
+def _begin_import():
     settings = {
         'import_bmesh': btn_import_bmesh.val,
         'remove_doubles': btn_remove_doubles.val,
@@ -414,6 +428,9 @@ def begin_import():
         # Ok
         set_log_file(f)
 
+    # per-triangle messages only with the saved log; otherwise they are counted
+    set_log_level(_save_log and LOG_DEBUG or LOG_INFO)
+
     #
     # begin import
     #